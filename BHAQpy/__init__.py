@@ -10,6 +10,16 @@ Seemlessly integrate python, QGIS and other air quality utilities.
 from BHAQpy.modelledroads import ModelledRoads
 from BHAQpy.trafficcountpoints import TrafficCountPoints
 from BHAQpy.aqgisproject import AQgisProject, AQgisProjectBasemap
-from BHAQpy.getdefrabackground import get_defra_background_concentrations
+from BHAQpy.getdefrabackground import (get_defra_background_concentrations,
+                                       get_defra_background_at_points,
+                                       get_defra_background_projections,
+                                       import_defra_background_maps,
+                                       build_background_region_index,
+                                       ROAD_SECTORS,
+                                       set_background_cache,
+                                       get_background_cache)
 from BHAQpy.aqmonitoring import AQMonitoring
-from BHAQpy.receptors import Receptors
\ No newline at end of file
+from BHAQpy.receptors import (Receptors, 
+                              set_geocode_cache, 
+                              get_geocode_cache, 
+                              build_address_point_index)
\ No newline at end of file
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Offline reverse geocoding from a local address point dataset (e.g. UPRN points with addresses).
+
+@author: kbenjamin
+"""
+
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+
+class AddressPointIndex():
+    """
+    A KD-tree over address points, for finding the nearest address to many
+    locations at once. Requires scipy.
+
+    Attributes
+    ----------
+    index_path : str
+        Path to the saved index file.
+
+    n_points : int
+        Number of address points in the index.
+
+    Methods
+    -------
+    build()
+        build an index from address points and save it
+
+    query()
+        get the nearest address to each location
+
+    """
+
+    def __init__(self, index_path):
+        """
+        Parameters
+        ----------
+        index_path : str
+            Path to an index file saved by AddressPointIndex.build (or BHAQpy.build_address_point_index).
+
+        Returns
+        -------
+        None.
+
+        """
+        if not os.path.exists(index_path):
+            raise Exception(f"Address point index {index_path} not found. Create with build_address_point_index")
+
+        with open(index_path, 'rb') as index_file:
+            index = pickle.load(index_file)
+
+        self.index_path = index_path
+        self._tree = index['tree']
+        self._addresses = index['addresses']
+        self.n_points = len(self._addresses)
+        return
+
+    @classmethod
+    def build(cls, x, y, addresses, index_path):
+        """
+        Build an index from address points and save it.
+
+        Parameters
+        ----------
+        x : array
+            X coordinates of the address points (same CRS as the locations that will be queried, e.g. EPSG:27700).
+        y : array
+            Y coordinates of the address points.
+        addresses : array
+            Address of each point.
+        index_path : str
+            Path to save the index file to.
+
+        Returns
+        -------
+        BHAQpy._addresspoints.AddressPointIndex
+            The saved index.
+
+        """
+        cKDTree = _import_kdtree()
+
+        points = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+        addresses = np.asarray(addresses, dtype=object)
+        if len(points) != len(addresses):
+            raise Exception("x, y and addresses must be the same length")
+
+        valid = np.isfinite(points).all(axis=1)
+        tree = cKDTree(points[valid])
+
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+        os.makedirs(index_dir, exist_ok=True)
+        with open(index_path, 'wb') as index_file:
+            pickle.dump({'tree' : tree, 'addresses' : addresses[valid]}, index_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+        return cls(index_path)
+
+    def query(self, x, y, max_distance=None):
+        """
+        Get the nearest address point to each location.
+
+        Parameters
+        ----------
+        x : array
+            X coordinates of the locations.
+        y : array
+            Y coordinates of the locations.
+        max_distance : float, optional
+            Locations with no address point within this distance get no address. The default is None (no limit).
+
+        Returns
+        -------
+        addresses : numpy.ndarray
+            Nearest address to each location, None where there is none within max_distance.
+        distances : numpy.ndarray
+            Distance to the nearest address point, inf where there is none within max_distance.
+
+        """
+        points = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+        upper_bound = np.inf if max_distance is None else max_distance
+        distances, point_idx = self._tree.query(points, k=1, distance_upper_bound=upper_bound)
+
+        # missing neighbours are returned with an index one past the end
+        found = point_idx < self.n_points
+        addresses = np.full(len(points), None, dtype=object)
+        addresses[found] = self._addresses[point_idx[found]]
+        return addresses, distances
+
+def _import_kdtree():
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        raise Exception("scipy is required for offline reverse geocoding. Install with pip install scipy")
+    return cKDTree
+
+def _read_address_points_csv(csv_path, x_field, y_field, address_fields):
+    point_df = pd.read_csv(csv_path, usecols=[x_field, y_field, *address_fields], dtype={
+        address_field : str for address_field in address_fields})
+    return (point_df[x_field].to_numpy(dtype=float), point_df[y_field].to_numpy(dtype=float),
+            _join_address_fields(point_df[address_fields]))
+
+def _join_address_fields(address_df):
+    # join address lines column by column, skipping blank ones
+    addresses = pd.Series('', index=address_df.index, dtype=object)
+    for col_n in address_df.columns:
+        lines = address_df[col_n].fillna('').astype(str).str.strip()
+        separators = np.where((addresses != '') & (lines != ''), ', ', '')
+        addresses = addresses + separators + lines
+    return addresses.to_numpy(dtype=object)
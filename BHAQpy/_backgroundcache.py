@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache for downloaded defra background map csv files.
+
+@author: kbenjamin
+"""
+
+import os
+import json
+import time
+import threading
+
+
+class BackgroundMapCache():
+    """
+    A size capped, least recently used cache of defra background map csv files.
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory in which cached csv files and the cache index are stored.
+
+    max_size_mb : float
+        Maximum total size of cached files in MB. Least recently used files are evicted above this.
+
+    ttl_days : float
+        Number of days a cached file is valid for. If None then cached files never expire.
+
+    Methods
+    -------
+    get_path()
+        get the path to a cached file, or None if not cached
+
+    put()
+        add a file to the cache
+
+    remove()
+        remove a file from the cache
+
+    stats()
+        get cache hit/miss statistics
+
+    clear()
+        remove all cached files
+
+    """
+
+    index_file_name = 'index.json'
+
+    def __init__(self, cache_dir=None, max_size_mb=500, ttl_days=None):
+        """
+        Parameters
+        ----------
+        cache_dir : str, optional
+            Directory to store cached files. The default is None, which uses ~/.BHAQpy/defra_background_cache.
+        max_size_mb : float, optional
+            Maximum total size of cached files in MB. The default is 500.
+        ttl_days : float, optional
+            Number of days a cached file is valid for. The default is None (never expire).
+
+        Returns
+        -------
+        None.
+
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.BHAQpy', 'defra_background_cache')
+
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        self.ttl_days = ttl_days
+
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = self._load_index()
+        return
+
+    def get_path(self, key):
+        """
+        Get the path of a cached file and mark it as recently used.
+
+        Parameters
+        ----------
+        key : tuple
+            (region, pollutant, year, base_year) identifying the file.
+
+        Returns
+        -------
+        str or None
+            Path to the cached file. None if not cached or expired.
+
+        """
+        key_str = _key_to_str(key)
+        with self._lock:
+            entry = self._index.get(key_str)
+            file_path = None if entry is None else os.path.join(self.cache_dir, entry['file'])
+
+            if entry is not None and (self._is_expired(entry) or not os.path.exists(file_path)):
+                self._remove_entry(key_str)
+                entry = None
+
+            if entry is None:
+                self._misses += 1
+                return None
+
+            entry['last_access'] = time.time()
+            self._hits += 1
+            self._save_index()
+
+        return file_path
+
+    def put(self, key, chunks, validate=None):
+        """
+        Write a file to the cache, evicting least recently used files if the cache is full.
+
+        Parameters
+        ----------
+        key : tuple
+            (region, pollutant, year, base_year) identifying the file.
+        chunks : iterable of bytes
+            Content of the file.
+        validate : callable, optional
+            Function taking the path of the downloaded file and raising an exception if it should not be cached. The default is None.
+
+        Returns
+        -------
+        file_path : str
+            Path to the cached file.
+
+        """
+        key_str = _key_to_str(key)
+        file_name = key_str + '.csv'
+        file_path = os.path.join(self.cache_dir, file_name)
+
+        # write to a temporary file first so a failed or invalid download never leaves a partial entry
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as cache_file:
+                for chunk in chunks:
+                    cache_file.write(chunk)
+            if validate is not None:
+                validate(tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            os.replace(tmp_path, file_path)
+            now = time.time()
+            self._index[key_str] = {'file' : file_name,
+                                    'size' : os.path.getsize(file_path),
+                                    'created' : now,
+                                    'last_access' : now}
+            self._evict(keep=key_str)
+            self._save_index()
+
+        return file_path
+
+    def remove(self, key):
+        """
+        Remove a file from the cache, if cached.
+
+        Parameters
+        ----------
+        key : tuple
+            (region, pollutant, year, base_year) identifying the file.
+
+        Returns
+        -------
+        None.
+
+        """
+        key_str = _key_to_str(key)
+        with self._lock:
+            if key_str in self._index:
+                self._remove_entry(key_str)
+                self._save_index()
+        return
+
+    def stats(self):
+        """
+        Get cache statistics
+
+        Returns
+        -------
+        dict
+            hits, misses, evictions, number of cached files and total cached size in MB.
+
+        """
+        with self._lock:
+            size = sum(entry['size'] for entry in self._index.values())
+            return {'hits' : self._hits,
+                    'misses' : self._misses,
+                    'evictions' : self._evictions,
+                    'files' : len(self._index),
+                    'size_mb' : size / 1e6}
+
+    def keys(self):
+        """
+        Get the keys of all cached (and unexpired) files.
+
+        Returns
+        -------
+        list
+            List of (region, pollutant, year, base_year) tuples.
+
+        """
+        with self._lock:
+            return [_str_to_key(key_str) for key_str, entry in self._index.items()
+                    if not self._is_expired(entry)]
+
+    def clear(self):
+        """
+        Remove all cached files and reset statistics.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock:
+            for key_str in list(self._index.keys()):
+                self._remove_entry(key_str)
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+            self._save_index()
+        return
+
+    def _is_expired(self, entry):
+        if self.ttl_days is None:
+            return False
+        return time.time() - entry['created'] > self.ttl_days * 86400
+
+    def _evict(self, keep=None):
+        max_size = self.max_size_mb * 1e6
+        total_size = sum(entry['size'] for entry in self._index.values())
+
+        lru_order = sorted(self._index.items(), key=lambda item: item[1]['last_access'])
+        for key_str, entry in lru_order:
+            if total_size <= max_size:
+                break
+            if key_str == keep:
+                continue
+            total_size -= entry['size']
+            self._remove_entry(key_str)
+            self._evictions += 1
+        return
+
+    def _remove_entry(self, key_str):
+        entry = self._index.pop(key_str)
+        file_path = os.path.join(self.cache_dir, entry['file'])
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return
+
+    def _load_index(self):
+        index_path = os.path.join(self.cache_dir, self.index_file_name)
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            with open(index_path, 'r') as index_file:
+                return json.load(index_file)
+        except ValueError:
+            # a corrupt index only loses track of the cached files
+            return {}
+
+    def _save_index(self):
+        index_path = os.path.join(self.cache_dir, self.index_file_name)
+        tmp_path = f"{index_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as index_file:
+            json.dump(self._index, index_file)
+        os.replace(tmp_path, index_path)
+        return
+
+def _key_to_str(key):
+    return '_'.join(str(i) for i in key)
+
+def _str_to_key(key_str):
+    # region names contain underscores so split from the right
+    region, pollutant, year, base_year = key_str.rsplit('_', 3)
+    return (region, pollutant, year, base_year)
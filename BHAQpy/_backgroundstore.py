@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Offline columnar store of defra background maps, for running without network access.
+
+@author: kbenjamin
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class BackgroundMapStore():
+    """
+    A local store of defra background maps, one directory of numpy arrays per
+    (region, pollutant, year, base_year). Arrays are memory-mapped when read so
+    only the rows looked up are loaded.
+
+    Attributes
+    ----------
+    store_dir : str
+        Directory containing the store.
+
+    Methods
+    -------
+    add()
+        add a background map dataframe to the store
+
+    read()
+        read a background map from the store as memory-mapped columns
+
+    keys()
+        get the (region, pollutant, year, base_year) of all stored background maps
+
+    """
+
+    index_file_name = 'index.json'
+
+    def __init__(self, store_dir):
+        """
+        Parameters
+        ----------
+        store_dir : str
+            Directory containing the store. Created if it does not exist.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+        index_path = os.path.join(store_dir, self.index_file_name)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as index_file:
+                self._index = json.load(index_file)
+        else:
+            self._index = {}
+        return
+
+    def __contains__(self, key):
+        return _key_to_str(key) in self._index
+
+    def keys(self):
+        """
+        Get the keys of all stored background maps
+
+        Returns
+        -------
+        list
+            List of (region, pollutant, year, base_year) tuples.
+
+        """
+        return [tuple(entry['key']) for entry in self._index.values()]
+
+    def add(self, key, pollutant_bg_df):
+        """
+        Write a background map to the store, replacing it if already stored.
+
+        Parameters
+        ----------
+        key : tuple
+            (region, pollutant, year, base_year) identifying the background map.
+        pollutant_bg_df : pandas.DataFrame
+            Background map as parsed from a defra csv file.
+
+        Returns
+        -------
+        None.
+
+        """
+        key_str = _key_to_str(key)
+        map_dir = os.path.join(self.store_dir, key_str)
+        os.makedirs(map_dir, exist_ok=True)
+
+        columns = []
+        for col_i, col_n in enumerate(pollutant_bg_df.columns):
+            values = pollutant_bg_df[col_n]
+            file_name = f'col_{col_i}.npy'
+            column_meta = {'name' : col_n, 'file' : file_name}
+
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                np.save(os.path.join(map_dir, file_name), values.cat.codes.to_numpy())
+                column_meta['categories'] = [str(i) for i in values.cat.categories]
+            else:
+                np.save(os.path.join(map_dir, file_name), values.to_numpy())
+
+            columns.append(column_meta)
+
+        with open(os.path.join(map_dir, 'meta.json'), 'w') as meta_file:
+            json.dump({'columns' : columns}, meta_file)
+
+        self._index[key_str] = {'key' : [str(i) for i in key], 'dir' : key_str}
+        with open(os.path.join(self.store_dir, self.index_file_name), 'w') as index_file:
+            json.dump(self._index, index_file)
+        return
+
+    def read(self, key, column_filter=None):
+        """
+        Read a background map from the store.
+
+        Parameters
+        ----------
+        key : tuple
+            (region, pollutant, year, base_year) identifying the background map.
+        column_filter : callable, optional
+            Function taking a column name and returning whether to read it. The default is None (read all).
+
+        Returns
+        -------
+        dict
+            Column name to memory-mapped numpy array (or pandas.Categorical for area code columns).
+
+        """
+        key_str = _key_to_str(key)
+        if key_str not in self._index:
+            raise Exception(f"{', '.join(str(i) for i in key)} background map not in offline store {self.store_dir}. "
+                            "Add with import_defra_background_maps")
+
+        map_dir = os.path.join(self.store_dir, self._index[key_str]['dir'])
+        with open(os.path.join(map_dir, 'meta.json'), 'r') as meta_file:
+            meta = json.load(meta_file)
+
+        columns = {}
+        for column_meta in meta['columns']:
+            col_n = column_meta['name']
+            if column_filter is not None and not column_filter(col_n):
+                continue
+
+            values = np.load(os.path.join(map_dir, column_meta['file']), mmap_mode='r')
+            if 'categories' in column_meta:
+                values = pd.Categorical.from_codes(values, column_meta['categories'])
+            columns[col_n] = values
+
+        return columns
+
+def _key_to_str(key):
+    return '_'.join(str(i) for i in key)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent SQLite cache of reverse geocoded addresses, shared across projects.
+
+@author: kbenjamin
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+
+class ReverseGeocodeCache():
+    """
+    A persistent cache of reverse geocoded addresses, keyed by latitude and
+    longitude rounded to a number of decimal places.
+
+    Attributes
+    ----------
+    cache_path : str
+        Path to the SQLite database file.
+
+    precision : int
+        Number of decimal places latitude and longitude are rounded to. 5 decimal places is about 1 m.
+
+    Methods
+    -------
+    get()
+        get the cached address at a location, or None if not cached
+
+    put()
+        add an address to the cache
+
+    stats()
+        get cache hit/miss statistics
+
+    clear()
+        remove all cached addresses
+
+    """
+
+    def __init__(self, cache_path=None, precision=5):
+        """
+        Parameters
+        ----------
+        cache_path : str, optional
+            Path to the SQLite database file. The default is None, which uses ~/.BHAQpy/reverse_geocode_cache.sqlite.
+        precision : int, optional
+            Number of decimal places latitude and longitude are rounded to. The default is 5.
+
+        Returns
+        -------
+        None.
+
+        """
+        if cache_path is None:
+            cache_path = os.path.join(os.path.expanduser('~'), '.BHAQpy', 'reverse_geocode_cache.sqlite')
+
+        cache_dir = os.path.dirname(os.path.abspath(cache_path))
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.cache_path = cache_path
+        self.precision = int(precision)
+
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS addresses ("
+                                     "precision INTEGER, lat INTEGER, lon INTEGER, "
+                                     "address TEXT, created REAL, "
+                                     "PRIMARY KEY (precision, lat, lon))")
+        return
+
+    def get(self, lat, lon):
+        """
+        Get a cached address.
+
+        Parameters
+        ----------
+        lat : float
+            Latitude (WGS84).
+        lon : float
+            Longitude (WGS84).
+
+        Returns
+        -------
+        str or None
+            Full address as returned by the geocoder. None if not cached.
+
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT address FROM addresses WHERE precision=? AND lat=? AND lon=?",
+                                           (self.precision, *self._key(lat, lon))).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            return row[0]
+
+    def put(self, lat, lon, address):
+        """
+        Add an address to the cache, replacing any address already cached at the location.
+
+        Parameters
+        ----------
+        lat : float
+            Latitude (WGS84).
+        lon : float
+            Longitude (WGS84).
+        address : str
+            Full address as returned by the geocoder.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?, ?)",
+                                     (self.precision, *self._key(lat, lon), address, time.time()))
+        return
+
+    def stats(self):
+        """
+        Get cache statistics
+
+        Returns
+        -------
+        dict
+            hits and misses since the cache was opened, and number of cached addresses at this precision.
+
+        """
+        with self._lock:
+            n_addresses = self._connection.execute("SELECT COUNT(*) FROM addresses WHERE precision=?",
+                                                   (self.precision,)).fetchone()[0]
+            return {'hits' : self._hits,
+                    'misses' : self._misses,
+                    'addresses' : n_addresses}
+
+    def clear(self):
+        """
+        Remove all cached addresses and reset statistics.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM addresses")
+            self._hits = 0
+            self._misses = 0
+        return
+
+    def _key(self, lat, lon):
+        # store as scaled integers so rounding is exact and comparable
+        scale = 10**self.precision
+        return (int(round(float(lat)*scale)), int(round(float(lon)*scale)))
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limited, resumable reverse geocoding of many locations.
+
+@author: kbenjamin
+"""
+
+import os
+import json
+import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+
+class TokenBucket():
+    """
+    Thread safe token bucket rate limiter. Tokens are added at a fixed rate up to
+    a capacity, and each request takes one token, waiting until one is available.
+
+    Attributes
+    ----------
+    rate : float
+        Tokens added per second.
+
+    capacity : float
+        Maximum number of tokens held, i.e. the largest burst of requests allowed.
+
+    """
+
+    def __init__(self, rate, capacity=1):
+        """
+        Parameters
+        ----------
+        rate : float
+            Tokens added per second.
+        capacity : float, optional
+            Maximum number of tokens held. The default is 1 (no bursts).
+
+        Returns
+        -------
+        None.
+
+        """
+        if rate <= 0:
+            raise Exception("Rate limit must be greater than 0 requests per second")
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        return
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+
+        Returns
+        -------
+        None.
+
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last)*self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens)/self.rate
+            time.sleep(wait_time)
+
+def reverse_geocode_locations(lats, lons, geolocator, cache=None, rate_limit=1, max_workers=2,
+                              checkpoint_path=None, precision=5, verbose=True):
+    '''
+    Reverse geocode locations, calling the geolocator once per unique rounded
+    location not already cached or checkpointed. Calls are spread over worker
+    threads and rate limited with a token bucket. Each result is appended to the
+    checkpoint file as it arrives, so an interrupted run resumes where it stopped.
+    Returns a list of addresses (None where no address was found), in input order.
+    '''
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+
+    # deduplicate identical locations
+    scale = 10**precision
+    keys = np.column_stack([np.round(lats*scale), np.round(lons*scale)]).astype(np.int64)
+    unique_keys, first_idx, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    addresses = _read_checkpoint(checkpoint_path)
+    n_checkpoint = sum(tuple(key) in addresses for key in unique_keys.tolist())
+
+    # look up the cache before queuing any geocoder calls
+    pending = []
+    n_cached = 0
+    for key, idx in zip(unique_keys.tolist(), first_idx):
+        key = tuple(key)
+        if key in addresses:
+            continue
+        address = None if cache is None else cache.get(lats[idx], lons[idx])
+        if address is not None:
+            addresses[key] = address
+            n_cached += 1
+        else:
+            pending.append((key, idx))
+
+    if verbose:
+        print(f"{len(lats)} locations, {len(unique_keys)} unique: {n_cached} from cache, "
+              f"{n_checkpoint} from checkpoint, {len(pending)} to geocode")
+
+    if len(pending) > 0:
+        bucket = TokenBucket(rate_limit)
+        checkpoint_lock = threading.Lock()
+        progress = {'done' : 0}
+
+        def geocode(key, idx):
+            bucket.acquire()
+            location = geolocator.reverse(f"{lats[idx]}, {lons[idx]}")
+            address = None if location is None else location.address
+
+            with checkpoint_lock:
+                addresses[key] = address
+                _append_checkpoint(checkpoint_path, key, address)
+                if cache is not None and address is not None:
+                    cache.put(lats[idx], lons[idx], address)
+                progress['done'] += 1
+                if verbose:
+                    print(f"{progress['done']}/{len(pending)} geocoded")
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(geocode, key, idx) for key, idx in pending]
+        try:
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        except BaseException:
+            # e.g. KeyboardInterrupt, so drop queued lookups rather than letting the workers run through them
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        # drop queued lookups after a failure, and let lookups in progress finish and be checkpointed
+        executor.shutdown(wait=True, cancel_futures=True)
+
+        for future in done:
+            if future.exception() is not None:
+                resume_msg = (f" Progress saved to {checkpoint_path}, rerun to resume."
+                              if checkpoint_path is not None else "")
+                raise Exception(f"Reverse geocoding failed after {progress['done']}/{len(pending)} locations."
+                                f"{resume_msg}") from future.exception()
+
+    # finished, so the checkpoint is no longer needed
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    unique_addresses = [addresses[tuple(key)] for key in unique_keys.tolist()]
+    return [unique_addresses[i] for i in inverse]
+
+def _read_checkpoint(checkpoint_path):
+    addresses = {}
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return addresses
+
+    with open(checkpoint_path, 'r') as checkpoint_file:
+        for line in checkpoint_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a partly written last line from an interrupted run
+                continue
+            addresses[(record['lat'], record['lon'])] = record['address']
+    return addresses
+
+def _append_checkpoint(checkpoint_path, key, address):
+    if checkpoint_path is None:
+        return
+    with open(checkpoint_path, 'a') as checkpoint_file:
+        checkpoint_file.write(json.dumps({'lat' : key[0], 'lon' : key[1], 'address' : address}) + '\n')
+    return
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Sample raster values at many points, reading only the raster blocks the points fall in.
+
+@author: kbenjamin
+"""
+
+import warnings
+import numpy as np
+
+from qgis.core import (
+    Qgis,
+    QgsRectangle,
+    QgsPointXY,
+    QgsProject,
+    QgsCoordinateTransform,
+    QgsCsException
+)
+
+
+def sample_rasters(raster_layers, x, y, points_crs, band=1, block_size=2048):
+    '''
+    value of the cell containing each point, from the first raster (in order)
+    covering it with data. Rasters are read in blocks of at most block_size x
+    block_size cells and only blocks containing points are read, so memory stays
+    bounded however large the rasters are and no merged raster is created.
+    Points are transformed from points_crs to each raster's crs where both are
+    valid and differ. Points on no data or outside all rasters are nan
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    values = np.full(len(x), np.nan)
+
+    for raster_layer in raster_layers:
+        unsampled = np.flatnonzero(np.isnan(values))
+        if len(unsampled) == 0:
+            break
+        raster_x, raster_y = _transform_points(x[unsampled], y[unsampled], points_crs, raster_layer.crs())
+        values[unsampled] = _sample_raster(raster_layer, raster_x, raster_y, band, block_size)
+
+    return values
+
+def _transform_points(x, y, from_crs, to_crs):
+    if not from_crs.isValid() or not to_crs.isValid():
+        # e.g. ascii grid tiles without a .prj, so assume the points are already in the raster's crs
+        warnings.warn("Points or raster have no valid crs, sampling without transforming points")
+        return x, y
+    if from_crs == to_crs:
+        return x, y
+
+    transform = QgsCoordinateTransform(from_crs, to_crs, QgsProject.instance())
+    out_x = np.full(len(x), np.nan)
+    out_y = np.full(len(y), np.nan)
+    for i, (point_x, point_y) in enumerate(zip(x, y)):
+        try:
+            point = transform.transform(QgsPointXY(point_x, point_y))
+        except QgsCsException:
+            # points that cannot be transformed are left unsampled
+            continue
+        out_x[i] = point.x()
+        out_y[i] = point.y()
+    return out_x, out_y
+
+def _sample_raster(raster_layer, x, y, band, block_size):
+    provider = raster_layer.dataProvider()
+    extent = provider.extent()
+    n_cols = provider.xSize()
+    n_rows = provider.ySize()
+    x_res = extent.width()/n_cols
+    y_res = extent.height()/n_rows
+
+    # cell of each point, by index arithmetic from the raster origin
+    # points that could not be transformed are nan, so move them outside the raster
+    finite = np.isfinite(x) & np.isfinite(y)
+    x = np.where(finite, x, extent.xMinimum() - x_res)
+    y = np.where(finite, y, extent.yMaximum() + y_res)
+    cols = np.floor((x - extent.xMinimum())/x_res).astype(np.int64)
+    rows = np.floor((extent.yMaximum() - y)/y_res).astype(np.int64)
+    inside = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+
+    values = np.full(len(x), np.nan)
+    if not inside.any():
+        return values
+
+    no_data = provider.sourceNoDataValue(band) if provider.sourceHasNoDataValue(band) else None
+
+    # read each block containing points once
+    point_idx = np.flatnonzero(inside)
+    block_keys = (rows[point_idx] // block_size)*(n_cols // block_size + 1) + cols[point_idx] // block_size
+    order = np.argsort(block_keys, kind='stable')
+    point_idx = point_idx[order]
+    block_starts = np.flatnonzero(np.concatenate([[True], np.diff(block_keys[order]) != 0]))
+    block_ends = np.append(block_starts[1:], len(point_idx))
+
+    for block_start, block_end in zip(block_starts, block_ends):
+        block_points = point_idx[block_start:block_end]
+        row_0 = (rows[block_points[0]] // block_size)*block_size
+        col_0 = (cols[block_points[0]] // block_size)*block_size
+        height = min(block_size, n_rows - row_0)
+        width = min(block_size, n_cols - col_0)
+
+        block_extent = QgsRectangle(extent.xMinimum() + col_0*x_res,
+                                    extent.yMaximum() - (row_0 + height)*y_res,
+                                    extent.xMinimum() + (col_0 + width)*x_res,
+                                    extent.yMaximum() - row_0*y_res)
+        block_values = _read_block(provider, band, block_extent, width, height, no_data)
+
+        values[block_points] = block_values[rows[block_points] - row_0, cols[block_points] - col_0]
+
+    return values
+
+def _read_block(provider, band, block_extent, width, height, no_data):
+    block = provider.block(band, block_extent, width, height)
+    dtype = _numpy_dtype(block.dataType())
+    block_values = np.frombuffer(bytes(block.data()), dtype=dtype).reshape(height, width).astype(float)
+
+    if no_data is not None:
+        block_values[block_values == no_data] = np.nan
+    if block.hasNoDataValue():
+        block_values[block_values == block.noDataValue()] = np.nan
+    return block_values
+
+def _numpy_dtype(data_type):
+    dtypes = {Qgis.Byte : np.uint8,
+              Qgis.UInt16 : np.uint16,
+              Qgis.Int16 : np.int16,
+              Qgis.UInt32 : np.uint32,
+              Qgis.Int32 : np.int32,
+              Qgis.Float32 : np.float32,
+              Qgis.Float64 : np.float64}
+    if data_type not in dtypes:
+        raise Exception(f"Raster data type {data_type} not supported for sampling")
+    return dtypes[data_type]
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Sort-tile-recursive (STR) packed R-tree over line segments, queried in bulk with numpy.
+
+@author: kbenjamin
+"""
+
+import numpy as np
+
+
+class SegmentSTRtree():
+    """
+    A static R-tree over line segments, packed with the sort-tile-recursive
+    algorithm. Nearest segment queries for many points are answered level by
+    level on arrays of (point, node) pairs, pruning nodes that cannot hold a
+    nearer segment, so there is no python loop over points or segments.
+
+    Attributes
+    ----------
+    n_segments : int
+        Number of segments in the tree.
+
+    node_size : int
+        Maximum number of children of each node.
+
+    Methods
+    -------
+    nearest()
+        get the nearest segment to each point
+
+    """
+
+    def __init__(self, x0, y0, x1, y1, node_size=8):
+        """
+        Parameters
+        ----------
+        x0, y0 : array
+            Start coordinates of each segment.
+        x1, y1 : array
+            End coordinates of each segment.
+        node_size : int, optional
+            Maximum number of children of each node. The default is 8.
+
+        Returns
+        -------
+        None.
+
+        """
+        segments = np.column_stack([x0, y0, x1, y1]).astype(float)
+        if len(segments) == 0:
+            raise Exception("Cannot build a tree with no segments")
+
+        self.n_segments = len(segments)
+        self.node_size = node_size
+
+        # leaves hold consecutive segments in STR order
+        order = _str_order((segments[:, 0] + segments[:, 2])/2, (segments[:, 1] + segments[:, 3])/2, node_size)
+        self._segment_ids = order
+        self._segments = segments[order]
+
+        bounds = np.column_stack([np.minimum(self._segments[:, 0], self._segments[:, 2]),
+                                  np.minimum(self._segments[:, 1], self._segments[:, 3]),
+                                  np.maximum(self._segments[:, 0], self._segments[:, 2]),
+                                  np.maximum(self._segments[:, 1], self._segments[:, 3])])
+
+        # build levels from the leaves up, each node pointing to a range of the level below
+        self._levels = []
+        while True:
+            starts = np.arange(0, len(bounds), node_size)
+            ends = np.minimum(starts + node_size, len(bounds))
+            node_bounds = np.column_stack([np.minimum.reduceat(bounds[:, 0], starts),
+                                           np.minimum.reduceat(bounds[:, 1], starts),
+                                           np.maximum.reduceat(bounds[:, 2], starts),
+                                           np.maximum.reduceat(bounds[:, 3], starts)])
+
+            if len(node_bounds) > node_size:
+                # order nodes so the next level up groups neighbouring nodes
+                order = _str_order((node_bounds[:, 0] + node_bounds[:, 2])/2,
+                                   (node_bounds[:, 1] + node_bounds[:, 3])/2, node_size)
+                node_bounds, starts, ends = node_bounds[order], starts[order], ends[order]
+
+            self._levels.append({'bounds' : node_bounds, 'starts' : starts, 'ends' : ends})
+            if len(node_bounds) <= node_size:
+                break
+            bounds = node_bounds
+
+        self._levels.reverse()
+        return
+
+    def nearest(self, x, y, max_distance=None, chunk_size=2000):
+        """
+        Get the nearest segment to each point.
+
+        Parameters
+        ----------
+        x : array
+            X coordinates of the points.
+        y : array
+            Y coordinates of the points.
+        max_distance : float, optional
+            Only find segments within this distance. The default is None (no limit).
+        chunk_size : int, optional
+            Number of points queried at once, limiting memory use. The default is 2000.
+
+        Returns
+        -------
+        segment_ids : numpy.ndarray
+            Index of the nearest segment (in the order passed to the tree) for each point. -1 where none within max_distance.
+        distances : numpy.ndarray
+            Distance to the nearest segment, inf where none within max_distance.
+
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        segment_ids = np.full(len(x), -1, dtype=np.int64)
+        distances = np.full(len(x), np.inf)
+        for chunk_start in range(0, len(x), chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            segment_ids[chunk], distances[chunk] = self._nearest_chunk(x[chunk], y[chunk], max_distance)
+
+        return segment_ids, distances
+
+    def _nearest_chunk(self, x, y, max_distance):
+        n_points = len(x)
+        max_d2 = np.inf if max_distance is None else float(max_distance)**2
+
+        # distance to a segment found by a quick descent gives an initial bound for pruning
+        upper_d2 = np.minimum(self._descend_dist2(x, y), max_d2)
+
+        # start with every point paired with every top level node
+        n_top = len(self._levels[0]['bounds'])
+        point_idx = np.repeat(np.arange(n_points), n_top)
+        node_idx = np.tile(np.arange(n_top), n_points)
+
+        for level in self._levels:
+            bounds = level['bounds'][node_idx]
+            px = x[point_idx]
+            py = y[point_idx]
+            min_d2 = _min_dist2(px, py, bounds)
+
+            # no segment is further than a node's minmax distance, so prune nodes further than the best of these
+            _group_minimum(upper_d2, point_idx, _min_max_dist2(px, py, bounds))
+
+            # bounds and exact distances round differently, so allow a little slack rather than prune the nearest node
+            keep = min_d2 <= upper_d2[point_idx]*(1 + 1e-9)
+            point_idx, node_idx = _expand_pairs(point_idx[keep], level['starts'][node_idx[keep]],
+                                                level['ends'][node_idx[keep]])
+
+        # exact distances to the remaining segments
+        d2 = _segment_dist2(x[point_idx], y[point_idx], self._segments[node_idx])
+
+        segment_ids = np.full(n_points, -1, dtype=np.int64)
+        distances = np.full(n_points, np.inf)
+        if len(d2) > 0:
+            first = _group_argmin(point_idx, d2)
+            first = first[d2[first] <= max_d2]
+            segment_ids[point_idx[first]] = self._segment_ids[node_idx[first]]
+            distances[point_idx[first]] = np.sqrt(d2[first])
+
+        return segment_ids, distances
+
+    def _descend_dist2(self, x, y):
+        # follow the nearest child at each level down to one leaf per point,
+        # and return the squared distance to the nearest segment in it
+        n_points = len(x)
+        n_top = len(self._levels[0]['bounds'])
+        point_idx = np.repeat(np.arange(n_points), n_top)
+        node_idx = np.tile(np.arange(n_top), n_points)
+
+        for level in self._levels:
+            min_d2 = _min_dist2(x[point_idx], y[point_idx], level['bounds'][node_idx])
+            best = _group_argmin(point_idx, min_d2)
+            point_idx, node_idx = _expand_pairs(point_idx[best], level['starts'][node_idx[best]],
+                                                level['ends'][node_idx[best]])
+
+        d2 = _segment_dist2(x[point_idx], y[point_idx], self._segments[node_idx])
+        descend_d2 = np.full(n_points, np.inf)
+        _group_minimum(descend_d2, point_idx, d2)
+        return descend_d2
+
+def _str_order(cx, cy, node_size):
+    '''
+    sort-tile-recursive ordering: vertical slices by x, then by y within each
+    slice, so consecutive runs of node_size items are spatially compact
+    '''
+    n_items = len(cx)
+    n_nodes = int(np.ceil(n_items/node_size))
+    n_slices = int(np.ceil(np.sqrt(n_nodes)))
+    slice_len = n_slices*node_size
+
+    slice_ids = np.empty(n_items, dtype=np.int64)
+    slice_ids[np.argsort(cx, kind='stable')] = np.arange(n_items) // slice_len
+    return np.lexsort((cy, slice_ids))
+
+def _expand_pairs(point_idx, starts, ends):
+    # replace each (point, node) pair with a pair for each child of the node
+    counts = ends - starts
+    child_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(point_idx, counts), np.repeat(starts, counts) + child_offsets
+
+def _group_minimum(out, group_idx, values):
+    # minimum of values into out for each group, for group_idx sorted
+    if len(values) == 0:
+        return
+    group_starts = np.flatnonzero(np.concatenate([[True], np.diff(group_idx) != 0]))
+    groups = group_idx[group_starts]
+    out[groups] = np.minimum(out[groups], np.minimum.reduceat(values, group_starts))
+    return
+
+def _group_argmin(group_idx, values):
+    # index of the minimum value in each group, for group_idx sorted
+    order = np.lexsort((values, group_idx))
+    return order[np.concatenate([[True], np.diff(group_idx[order]) != 0])]
+
+def _min_dist2(px, py, bounds):
+    dx = np.maximum(np.maximum(bounds[:, 0] - px, 0), px - bounds[:, 2])
+    dy = np.maximum(np.maximum(bounds[:, 1] - py, 0), py - bounds[:, 3])
+    return dx*dx + dy*dy
+
+def _min_max_dist2(px, py, bounds):
+    # every edge of a node's bounding box touches a segment, so one is within
+    # the nearer edge on one axis and the further edge on the other
+    mid_x = (bounds[:, 0] + bounds[:, 2])/2
+    mid_y = (bounds[:, 1] + bounds[:, 3])/2
+    near_x = np.where(px <= mid_x, bounds[:, 0], bounds[:, 2])
+    near_y = np.where(py <= mid_y, bounds[:, 1], bounds[:, 3])
+    far_x = np.where(px >= mid_x, bounds[:, 0], bounds[:, 2])
+    far_y = np.where(py >= mid_y, bounds[:, 1], bounds[:, 3])
+    return np.minimum((px - near_x)**2 + (py - far_y)**2,
+                      (px - far_x)**2 + (py - near_y)**2)
+
+def _segment_dist2(px, py, segments):
+    vx = segments[:, 2] - segments[:, 0]
+    vy = segments[:, 3] - segments[:, 1]
+    wx = px - segments[:, 0]
+    wy = py - segments[:, 1]
+    length2 = vx*vx + vy*vy
+
+    # position of the closest point along the segment, 0 for zero length segments
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(length2 > 0, (wx*vx + wy*vy)/length2, 0)
+    t = np.clip(t, 0, 1)
+
+    dx = wx - t*vx
+    dy = wy - t*vy
+    return dx*dx + dy*dy
@@ -8,7 +8,10 @@ Created on Wed Mar 30 11:14:43 2022
 import os
 import csv
 import warnings
+import threading
+import numpy as np
 import pandas as pd
+from pyproj import Transformer
 from qgis.core import (
     QgsVectorLayer,
     QgsRasterFileWriter,
@@ -21,6 +24,10 @@ import processing
 
 from BHAQpy._MyFeedback import MyFeedBack
 
+# transformers are slow to create so are shared, keyed by (from crs, to crs)
+_transformers = {}
+_transformers_lock = threading.Lock()
+
 def select_layer_by_name(layer_name, project):
     '''
     Select a layer by name
@@ -116,4 +123,23 @@ def save_raster(layer, gpkg_path):
     # add raster layer in new location
     raster_layer = QgsRasterLayer(file_name, layer_name)
     
-    return raster_layer
\ No newline at end of file
+    return raster_layer
+
+def get_transformer(from_crs, to_crs):
+    '''
+    get a shared pyproj transformer between two crs
+    '''
+    key = (str(from_crs).lower(), str(to_crs).lower())
+    with _transformers_lock:
+        if key not in _transformers:
+            _transformers[key] = Transformer.from_crs(from_crs, to_crs)
+        return _transformers[key]
+
+def transform_coordinates(x, y, from_crs="epsg:27700", to_crs="epsg:4326"):
+    '''
+    transform arrays of coordinates in one call. Output is in the axis order 
+    of to_crs, i.e. (lat, lon) for epsg:4326
+    '''
+    transformer = get_transformer(from_crs, to_crs)
+    out_a, out_b = transformer.transform(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    return np.asarray(out_a), np.asarray(out_b)
@@ -401,7 +401,8 @@ class AQgisProject(AQgisProjectBasemap):
     
     def get_site_background_concs(self, background_region, year, 
                                   pollutants = ['no2', 'nox', 'pm10', 'pm25'],
-                                  base_year = '2018', split_by_source=False):
+                                  base_year = '2018', split_by_source=False,
+                                  offline_store=None, sectors=None):
         """
         Get defra background concentrations at the project site from https://uk-air.defra.gov.uk/data/laqm-background-maps?year=2018
 
@@ -419,6 +420,12 @@ class AQgisProject(AQgisProjectBasemap):
             Base year of modelled background concentrations. The default is '2018'.
         split_by_source : Bool, optional
             Whether to split contributions of background concentrations into sources. The default is False.
+        offline_store : str, optional
+            Path to an offline background map store created with BHAQpy.import_defra_background_maps. 
+            If not None, background maps are read from the store with no network access. The default is None.
+        sectors : list, optional
+            Source sectors to get in addition to total concentrations, e.g. BHAQpy.ROAD_SECTORS. 
+            Only these sector columns are read. The default is None.
 
         Returns
         -------
@@ -439,7 +446,9 @@ class AQgisProject(AQgisProjectBasemap):
         site_background_concs = get_defra_background_concentrations(coordinates, 
                                                                    background_region, year, 
                                                                    pollutants, base_year, 
-                                                                   split_by_source)
+                                                                   split_by_source,
+                                                                   offline_store=offline_store,
+                                                                   sectors=sectors)
         
         return site_background_concs
         
@@ -5,14 +5,45 @@ Created on Thu Mar 17 11:46:13 2022
 @author: kbenjamin
 """
 
+import io
+import os
+import zipfile
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import numpy as np
 
-def get_defra_background_concentrations(coordinates : list, background_region : str, 
+from BHAQpy._backgroundcache import BackgroundMapCache
+from BHAQpy._backgroundstore import BackgroundMapStore
+
+DEFRA_BACKGROUND_MAPS_URL = 'https://uk-air.defra.gov.uk/data/laqm-background-maps.php'
+
+ROAD_SECTORS = ['Motorway_in', 'Motorway_out', 'Trunk_A_Rd_in', 'Trunk_A_Rd_out', 
+                'Primary_A_Rd_in', 'Primary_A_Rd_out', 'Minor_Rd+Cold_Start_in', 
+                'Minor_Rd+Cold_Start_out']
+
+_background_cache = None
+_background_cache_lock = threading.Lock()
+
+_grid_memo = OrderedDict()
+_grid_memo_size = 8
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+def get_defra_background_concentrations(coordinates : list, background_region, 
                                         year : int, 
                                         pollutants = ['no2', 'nox', 'pm10', 'pm25'],
-                                        base_year = '2018', split_by_source=False):
+                                        base_year = '2018', split_by_source=False,
+                                        use_cache=True, max_workers=4, offline_store=None,
+                                        sectors=None):
     """
     Get defra modelled background concentrations at specified coordinates.
 
@@ -20,8 +51,10 @@ def get_defra_background_concentrations(coordinates : list, background_region :
     ----------
     coordinates : list
         List of coordinates representing a singular point or a maximum and minimum extent. Must be in epsg:27700 crs. e.g. [5000, 7000] or [[50000, 70000], [51000, 71000]]
-    background_region : str
+    background_region : str, list or None
         Background region as defined in defra background maps. Options: Greater_London, East_of_England, Midlands, Northern_England, Northern_Ireland, Scotland, Southern_England, Wales.
+        If a list of regions or None (all Great Britain regions), the region of each grid square is resolved from cached or offline background maps (see build_background_region_index), so a query can span several regions.
+        Northern_Ireland is on the Irish grid, which overlaps Great Britain coordinates, so it is only used when listed explicitly.
     year : int
         The background year to get.
     pollutants : list, optional
@@ -30,6 +63,15 @@ def get_defra_background_concentrations(coordinates : list, background_region :
         Base year of modelled background concentrations. The default is '2018'.
     split_by_source : Bool, optional
         Whether to split contributions of background concentrations into sources. The default is False.
+    use_cache : Bool, optional
+        Whether to read and store downloaded background maps in the on-disk cache (see set_background_cache). The default is True.
+    max_workers : int, optional
+        Maximum number of pollutant background maps downloaded concurrently. 1 downloads one after another. The default is 4.
+    offline_store : str, optional
+        Path to an offline background map store created with import_defra_background_maps. If not None, background maps are read from the store with no network access. The default is None.
+    sectors : list, optional
+        Source sectors to get, in addition to total concentrations, e.g. ROAD_SECTORS to remove double counting of modelled roads. 
+        Only these sector columns are read. Sector names are column names without the pollutant and year, e.g. Motorway_in. The default is None (all sectors if split_by_source, otherwise none).
 
     Returns
     -------
@@ -38,6 +80,536 @@ def get_defra_background_concentrations(coordinates : list, background_region :
 
     """
     
+    coordinates = _coordinates_to_extent(coordinates)
+    
+    _check_background_inputs(background_region, pollutants)
+    
+    regions = _resolve_extent_regions(coordinates, background_region, use_cache, offline_store)
+    
+    region_background_concentrations = []
+    for region in regions:
+        grid = _get_background_grid(region, year, pollutants, base_year, 
+                                    use_cache, max_workers, _sector_selection(split_by_source, sectors),
+                                    offline_store)
+        
+        rows = grid.rows_in_extent(coordinates[0][0], coordinates[0][1], 
+                                   coordinates[1][0], coordinates[1][1])
+        region_background_concentrations.append(grid.to_frame(rows))
+    
+    if len(region_background_concentrations) == 1:
+        background_concentrations = region_background_concentrations[0]
+    else:
+        background_concentrations = pd.concat(region_background_concentrations, ignore_index=True)
+        background_concentrations = background_concentrations.drop_duplicates(['x', 'y'], ignore_index=True)
+    
+    if not split_by_source and sectors is None:
+        keep_columns = ['Local_Auth_Code', 'x', 'y', 'geo_area', 'EU_zone_agglom_01']
+        total_columns = [col_n for col_n in list(background_concentrations.columns) if 'Total_' in col_n]
+        
+        keep_columns.extend(total_columns)
+        
+        background_concentrations = background_concentrations[keep_columns]
+        
+        background_concentrations.loc['mean'] = background_concentrations[total_columns].mean()
+        
+    return background_concentrations
+
+class _BackgroundGrid():
+    '''
+    A region's background map held as dense arrays with one row per 1 km grid
+    square, and an index from grid square (x//1000, y//1000) to row. Pollutant
+    columns line up by row so no merging is needed.
+    '''
+    
+    key_columns = ['Local_Auth_Code', 'x', 'y', 'geo_area', 'EU_zone_agglom_01']
+    
+    def __init__(self, x, y, attributes):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.attributes = attributes
+        self.columns = {}
+        
+        grid_x = np.floor(self.x/1000).astype(np.int64)
+        grid_y = np.floor(self.y/1000).astype(np.int64)
+        
+        self._grid_x0 = grid_x.min() if len(grid_x) else 0
+        self._grid_y0 = grid_y.min() if len(grid_y) else 0
+        shape = ((grid_x.max() - self._grid_x0 + 1) if len(grid_x) else 0,
+                 (grid_y.max() - self._grid_y0 + 1) if len(grid_y) else 0)
+        
+        self._index = np.full(shape, -1, dtype=np.int32)
+        self._index[grid_x - self._grid_x0, grid_y - self._grid_y0] = np.arange(len(self.x))
+        return
+    
+    def __len__(self):
+        return len(self.x)
+    
+    def rows_at(self, x, y):
+        '''
+        row of the grid square each point is within. -1 if not in this region
+        '''
+        grid_x = np.floor(np.asarray(x, dtype=float)/1000).astype(np.int64)
+        grid_y = np.floor(np.asarray(y, dtype=float)/1000).astype(np.int64)
+        return self._rows_at_squares(grid_x, grid_y)
+    
+    def bilinear_weights(self, x, y):
+        '''
+        rows and weights of the four grid squares whose centres surround each 
+        point, for bilinear interpolation. Rows are -1 where a square is not in 
+        this region. Both arrays have shape (n, 4)
+        '''
+        # position in units of grid squares, relative to square centres
+        centre_x = np.asarray(x, dtype=float)/1000 - 0.5
+        centre_y = np.asarray(y, dtype=float)/1000 - 0.5
+        
+        grid_x = np.floor(centre_x).astype(np.int64)
+        grid_y = np.floor(centre_y).astype(np.int64)
+        t_x = centre_x - grid_x
+        t_y = centre_y - grid_y
+        
+        rows = np.stack([self._rows_at_squares(grid_x, grid_y),
+                         self._rows_at_squares(grid_x + 1, grid_y),
+                         self._rows_at_squares(grid_x, grid_y + 1),
+                         self._rows_at_squares(grid_x + 1, grid_y + 1)], axis=1)
+        weights = np.stack([(1 - t_x)*(1 - t_y), t_x*(1 - t_y), 
+                            (1 - t_x)*t_y, t_x*t_y], axis=1)
+        return rows, weights
+    
+    def interpolate(self, col_name, rows, weights):
+        '''
+        bilinear interpolation of a column using bilinear_weights output. 
+        Missing squares are left out and the remaining weights rescaled
+        '''
+        values = np.asarray(self.columns[col_name], dtype=float)[np.where(rows >= 0, rows, 0)]
+        available = (rows >= 0) & ~np.isnan(values)
+        weights = np.where(available, weights, 0)
+        
+        weight_sums = weights.sum(axis=1)
+        weighted_values = np.where(available, values, 0)*weights
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            interpolated = weighted_values.sum(axis=1)/weight_sums
+        interpolated[weight_sums == 0] = np.nan
+        return interpolated
+    
+    def _rows_at_squares(self, grid_x, grid_y):
+        grid_x = grid_x - self._grid_x0
+        grid_y = grid_y - self._grid_y0
+        
+        in_bounds = ((grid_x >= 0) & (grid_x < self._index.shape[0]) & 
+                     (grid_y >= 0) & (grid_y < self._index.shape[1]))
+        
+        rows = np.full(np.shape(grid_x), -1, dtype=np.int32)
+        rows[in_bounds] = self._index[grid_x[in_bounds], grid_y[in_bounds]]
+        return rows
+    
+    def rows_in_extent(self, x_min, y_min, x_max, y_max):
+        '''
+        rows of all grid squares overlapping an extent, in file order
+        '''
+        grid_x_min = int(np.floor(x_min/1000))
+        grid_y_min = int(np.floor(y_min/1000))
+        # squares only touching the maximum edge are excluded, unless the extent is a point on an edge
+        grid_x_max = max(int(np.ceil(x_max/1000)) - 1, grid_x_min)
+        grid_y_max = max(int(np.ceil(y_max/1000)) - 1, grid_y_min)
+        
+        block = self._index[max(grid_x_min - self._grid_x0, 0):max(grid_x_max - self._grid_x0 + 1, 0),
+                            max(grid_y_min - self._grid_y0, 0):max(grid_y_max - self._grid_y0 + 1, 0)]
+        rows = block[block >= 0]
+        return np.sort(rows)
+    
+    def add_columns(self, x, y, columns):
+        '''
+        add value columns from another background map of the same region, 
+        aligned to this grid by grid square
+        '''
+        if np.array_equal(x, self.x) and np.array_equal(y, self.y):
+            # same squares in the same order, so no alignment (or copy) needed
+            self.columns.update(columns)
+            return
+        
+        rows = self.rows_at(x, y)
+        in_grid = rows >= 0
+        for col_name, values in columns.items():
+            aligned = np.full(len(self), np.nan, dtype=np.asarray(values).dtype)
+            aligned[rows[in_grid]] = np.asarray(values)[in_grid]
+            self.columns[col_name] = aligned
+        return
+    
+    def to_frame(self, rows, columns=None):
+        '''
+        dataframe of key columns and value columns for the given rows
+        '''
+        if columns is None:
+            columns = list(self.columns.keys())
+        
+        frame_data = {'x' : self.x[rows], 'y' : self.y[rows]}
+        for col_name, values in self.attributes.items():
+            frame_data[col_name] = values[rows]
+        for col_name in columns:
+            frame_data[col_name] = self.columns[col_name][rows]
+        
+        key_columns = [col_n for col_n in self.key_columns if col_n in frame_data]
+        frame = pd.DataFrame(frame_data)
+        return frame[key_columns + columns]
+
+def get_defra_background_at_points(xy_array, background_region, year : int,
+                                   pollutants = ['no2', 'nox', 'pm10', 'pm25'],
+                                   base_year = '2018', split_by_source=False, ids=None,
+                                   use_cache=True, max_workers=4, offline_store=None,
+                                   sectors=None, interpolate=False):
+    """
+    Get defra modelled background concentrations at many points at once. 
+    Each pollutant background map is downloaded once and all points are looked up together.
+
+    Parameters
+    ----------
+    xy_array : array-like
+        Array of point coordinates with shape (n, 2). Must be in epsg:27700 crs. e.g. [[531236, 185725], [531900, 186100]]
+    background_region : str, list or None
+        Background region as defined in defra background maps. Options: Greater_London, East_of_England, Midlands, Northern_England, Northern_Ireland, Scotland, Southern_England, Wales.
+        If a list of regions or None (all Great Britain regions), the region of each grid square is resolved from cached or offline background maps (see build_background_region_index), so a query can span several regions.
+        Northern_Ireland is on the Irish grid, which overlaps Great Britain coordinates, so it is only used when listed explicitly.
+    year : int
+        The background year to get.
+    pollutants : list, optional
+        Pollutants to get background concentrations for. The default is ['no2', 'nox', 'pm10', 'pm25'].
+    base_year : int, optional
+        Base year of modelled background concentrations. The default is '2018'.
+    split_by_source : Bool, optional
+        Whether to split contributions of background concentrations into sources. The default is False.
+    ids : array-like, optional
+        ID of each point, e.g. receptor IDs. If not None these are added as an ID column. The default is None.
+    use_cache : Bool, optional
+        Whether to read and store downloaded background maps in the on-disk cache (see set_background_cache). The default is True.
+    max_workers : int, optional
+        Maximum number of pollutant background maps downloaded concurrently. The default is 4.
+    offline_store : str, optional
+        Path to an offline background map store created with import_defra_background_maps. If not None, background maps are read from the store with no network access. The default is None.
+    sectors : list, optional
+        Source sectors to get, in addition to total concentrations, e.g. ROAD_SECTORS to remove double counting of modelled roads. 
+        Only these sector columns are read. Sector names are column names without the pollutant and year, e.g. Motorway_in. The default is None (all sectors if split_by_source, otherwise none).
+
+    interpolate : Bool, optional
+        If True, concentrations are bilinearly interpolated between 1 km grid square centres, rather than taken as the value of the square each point is in. 
+        This removes step changes at square edges. The default is False.
+
+    Returns
+    -------
+    points_background_concentrations : pandas.DataFrame
+        Dataframe with one row per point, in the order given, with the grid square centre and background concentrations. 
+        Points outside the background region have null concentrations.
+
+    """
+    
+    xy_array = np.asarray(xy_array, dtype=float)
+    if xy_array.ndim != 2 or xy_array.shape[1] != 2:
+        raise Exception("xy_array must have shape (n, 2)")
+    
+    if ids is not None and len(ids) != len(xy_array):
+        raise Exception("ids must be the same length as xy_array")
+    
+    _check_background_inputs(background_region, pollutants)
+    
+    point_regions = _resolve_point_regions(xy_array[:, 0], xy_array[:, 1], background_region, 
+                                           use_cache, offline_store)
+    
+    points_data = {}
+    if ids is not None:
+        points_data['ID'] = np.asarray(ids)
+    points_data['Grid sq x'] = np.floor(xy_array[:, 0]/1000)*1000 + 500
+    points_data['Grid sq y'] = np.floor(xy_array[:, 1]/1000)*1000 + 500
+    if not isinstance(background_region, str):
+        points_data['Background region'] = point_regions
+    
+    # each region's background maps are fetched once for all points within it
+    for region in pd.unique(point_regions[pd.notnull(point_regions)]):
+        region_points = np.flatnonzero(point_regions == region)
+        
+        grid = _get_background_grid(region, year, pollutants, base_year, 
+                                    use_cache, max_workers, _sector_selection(split_by_source, sectors),
+                                    offline_store)
+        
+        value_columns = list(grid.columns.keys())
+        
+        if interpolate:
+            rows, weights = grid.bilinear_weights(xy_array[region_points, 0], xy_array[region_points, 1])
+            for col_n in value_columns:
+                if col_n not in points_data:
+                    points_data[col_n] = np.full(len(xy_array), np.nan)
+                points_data[col_n][region_points] = grid.interpolate(col_n, rows, weights)
+            continue
+        
+        rows = grid.rows_at(xy_array[region_points, 0], xy_array[region_points, 1])
+        
+        in_grid = rows >= 0
+        for col_n in value_columns:
+            if col_n not in points_data:
+                points_data[col_n] = np.full(len(xy_array), np.nan, dtype=grid.columns[col_n].dtype)
+            points_data[col_n][region_points[in_grid]] = grid.columns[col_n][rows[in_grid]]
+    
+    points_background_concentrations = pd.DataFrame(points_data)
+    
+    return points_background_concentrations
+
+def get_defra_background_projections(coordinates : list, background_region : str, years : list,
+                                     pollutants = ['no2', 'nox', 'pm10', 'pm25'],
+                                     base_year = '2018', use_cache=True, max_workers=4,
+                                     offline_store=None):
+    """
+    Get defra modelled background concentrations for several years at once, e.g. every year from the base year to an opening year.
+    All background maps are downloaded concurrently and cached.
+
+    Parameters
+    ----------
+    coordinates : list
+        List of coordinates representing a singular point or a maximum and minimum extent. Must be in epsg:27700 crs. e.g. [5000, 7000] or [[50000, 70000], [51000, 71000]]
+    background_region : str
+        Background region as defined in defra background maps. Options: Greater_London, East_of_England, Midlands, Northern_England, Northern_Ireland, Scotland, Southern_England, Wales.
+        Must be a single region (lists and None are not supported here).
+    years : list
+        The background years to get. e.g. list(range(2022, 2031))
+    pollutants : list, optional
+        Pollutants to get background concentrations for. The default is ['no2', 'nox', 'pm10', 'pm25'].
+    base_year : int, optional
+        Base year of modelled background concentrations. The default is '2018'.
+    use_cache : Bool, optional
+        Whether to read and store downloaded background maps in the on-disk cache (see set_background_cache). The default is True.
+    max_workers : int, optional
+        Maximum number of background maps downloaded concurrently. The default is 4.
+    offline_store : str, optional
+        Path to an offline background map store created with import_defra_background_maps. If not None, background maps are read from the store with no network access. The default is None.
+
+    Returns
+    -------
+    background_projections : pandas.DataFrame
+        Long format dataframe with columns x, y, year, pollutant and concentration. 
+        One row per grid square, year and pollutant. Pivot with e.g. background_projections.pivot_table(index=['x', 'y', 'year'], columns='pollutant', values='concentration')
+
+    """
+    
+    coordinates = _coordinates_to_extent(coordinates)
+    
+    if np.ndim(years) == 0:
+        years = [years]
+    
+    if not isinstance(background_region, str):
+        raise Exception("background_region must be a single region name for background projections, "
+                        f"e.g. one of: {', '.join(_valid_regions())}")
+    _check_background_inputs(background_region, pollutants)
+    
+    map_keys = [(background_region, pollutant, year, base_year) for year in years 
+                for pollutant in pollutants]
+    pollutant_bg_dfs = _get_background_maps(map_keys, use_cache, max_workers, 
+                                            offline_store=offline_store)
+    
+    background_projections = []
+    for year_i, year in enumerate(years):
+        year_bg_dfs = pollutant_bg_dfs[year_i*len(pollutants):(year_i+1)*len(pollutants)]
+        grid = _build_background_grid(year_bg_dfs)
+        
+        rows = grid.rows_in_extent(coordinates[0][0], coordinates[0][1], 
+                                   coordinates[1][0], coordinates[1][1])
+        
+        for pollutant, pollutant_bg_df in zip(pollutants, year_bg_dfs):
+            total_column = [col_n for col_n in pollutant_bg_df.keys() if 'Total_' in col_n][0]
+            
+            background_projections.append(pd.DataFrame({'x' : grid.x[rows], 
+                                                        'y' : grid.y[rows],
+                                                        'year' : int(year),
+                                                        'pollutant' : pollutant,
+                                                        'concentration' : grid.columns[total_column][rows]}))
+    
+    background_projections = pd.concat(background_projections, ignore_index=True)
+    background_projections['pollutant'] = background_projections['pollutant'].astype('category')
+    
+    return background_projections
+
+def import_defra_background_maps(source, store_dir, base_year = '2018'):
+    """
+    Import downloaded defra background map csv files into an offline store, so background concentrations can be got with no network access.
+    
+    The region is taken from each file name (e.g. Greater_London_no2_2022.csv) and the pollutant and year from its Total_ column.
+
+    Parameters
+    ----------
+    source : str
+        A folder or zip file containing defra background map csv files.
+    store_dir : str
+        Directory of the offline store. Created if it does not exist. Pass as offline_store to get_defra_background_concentrations.
+    base_year : int, optional
+        Base year of the background maps. The default is '2018'.
+
+    Returns
+    -------
+    imported : pandas.DataFrame
+        Dataframe with the file, region, pollutant, year and base year of each imported background map.
+
+    """
+    
+    if not os.path.exists(source):
+        raise Exception(f"source {source} not found")
+    
+    store = BackgroundMapStore(store_dir)
+    
+    imported = []
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as source_zip:
+            csv_names = [name for name in source_zip.namelist() if name.lower().endswith('.csv')]
+            for csv_name in csv_names:
+                with source_zip.open(csv_name) as csv_file:
+                    key = _import_background_map_csv(csv_file, csv_name, base_year, store)
+                imported.append([csv_name, *key])
+    elif os.path.isdir(source):
+        csv_names = [name for name in sorted(os.listdir(source)) if name.lower().endswith('.csv')]
+        for csv_name in csv_names:
+            with open(os.path.join(source, csv_name), 'rb') as csv_file:
+                key = _import_background_map_csv(csv_file, csv_name, base_year, store)
+            imported.append([csv_name, *key])
+    else:
+        raise Exception("source must be a folder or zip file of defra background map csv files")
+    
+    if len(imported) == 0:
+        raise Exception(f"No csv files found in {source}")
+    
+    imported = pd.DataFrame(imported, columns=['file', 'region', 'pollutant', 'year', 'base_year'])
+    return imported
+
+def build_background_region_index(regions=None, base_year = '2018', use_cache=True, 
+                                  max_workers=4, offline_store=None):
+    """
+    Build the index of which background region each grid square is in. This lets background_region be left as None 
+    (or a list of regions) in get_defra_background_concentrations and get_defra_background_at_points.
+    
+    One background map per region is downloaded into the cache if not already there. 
+    The index is saved in the cache directory and extended as more regions are cached.
+
+    Parameters
+    ----------
+    regions : list, optional
+        Background regions to index. The default is None (all regions).
+    base_year : int, optional
+        Base year of modelled background concentrations. The default is '2018'.
+    use_cache : Bool, optional
+        Must be True unless offline_store is set, as the index is built from cached background maps. The default is True.
+    max_workers : int, optional
+        Maximum number of background maps downloaded concurrently. The default is 4.
+    offline_store : str, optional
+        Path to an offline background map store created with import_defra_background_maps. If not None, the index is built from the store with no network access. The default is None.
+
+    Returns
+    -------
+    region_squares : pandas.Series
+        Number of grid squares indexed in each region.
+
+    """
+    
+    if regions is None:
+        regions = _valid_regions()
+    
+    _check_background_inputs(regions, [])
+    
+    if offline_store is None:
+        if not use_cache:
+            raise Exception("use_cache must be True to build the region index from downloaded background maps")
+        
+        cached_regions = set(key[0] for key in get_background_cache().keys())
+        map_keys = [(region, 'no2', base_year, base_year) for region in regions 
+                    if region not in cached_regions]
+        _get_background_maps(map_keys, use_cache, max_workers)
+    
+    region_index = _get_region_index(use_cache, offline_store)
+    
+    region_squares = pd.Series({region : len(region_index.region_squares.get(region, [])) 
+                                for region in regions})
+    return region_squares
+
+class _BackgroundRegionIndex():
+    '''
+    The background region each 1 km grid square is in, as sorted arrays of 
+    grid square keys per region.
+    '''
+    
+    def __init__(self, region_squares):
+        self.region_squares = region_squares
+        return
+    
+    @staticmethod
+    def square_keys(x, y):
+        grid_x = np.floor(np.asarray(x, dtype=float)/1000).astype(np.int64)
+        grid_y = np.floor(np.asarray(y, dtype=float)/1000).astype(np.int64)
+        return grid_x*100000 + grid_y
+    
+    def regions_at(self, x, y, candidate_regions):
+        '''
+        region of each point, None if not in any indexed candidate region
+        '''
+        keys = self.square_keys(x, y)
+        regions = np.full(len(keys), None, dtype=object)
+        
+        # Northern Ireland maps are on the Irish grid, which overlaps Great 
+        # Britain coordinates, so only match it after all other regions
+        ordered_regions = sorted(candidate_regions, key=lambda region: region == 'Northern_Ireland')
+        for region in ordered_regions:
+            if region not in self.region_squares:
+                continue
+            unresolved = regions == None
+            in_region = np.isin(keys, self.region_squares[region], assume_unique=False) & unresolved
+            regions[in_region] = region
+        
+        return regions
+
+def set_background_cache(cache_dir=None, max_size_mb=500, ttl_days=None):
+    """
+    Configure the on-disk cache of downloaded defra background maps.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory to store cached files. The default is None, which uses ~/.BHAQpy/defra_background_cache.
+    max_size_mb : float, optional
+        Maximum total size of cached files in MB. Least recently used files are removed above this. The default is 500.
+    ttl_days : float, optional
+        Number of days a downloaded background map is reused for. The default is None (never re-download).
+
+    Returns
+    -------
+    BackgroundMapCache
+        The cache used by get_defra_background_concentrations.
+
+    """
+    global _background_cache
+    with _background_cache_lock:
+        _background_cache = BackgroundMapCache(cache_dir, max_size_mb, ttl_days)
+        _grid_memo.clear()
+        return _background_cache
+
+def get_background_cache():
+    """
+    Get the on-disk cache of downloaded defra background maps, creating one with default settings if not already set.
+
+    Returns
+    -------
+    BackgroundMapCache
+        The cache used by get_defra_background_concentrations. Use .stats() for hit/miss statistics and .clear() to empty it.
+
+    """
+    global _background_cache
+    # download workers can call this at once, so only one of them may create the default cache
+    with _background_cache_lock:
+        if _background_cache is None:
+            _background_cache = BackgroundMapCache()
+            _grid_memo.clear()
+        return _background_cache
+
+def _sector_selection(split_by_source, sectors):
+    if sectors is not None:
+        if isinstance(sectors, str):
+            sectors = [sectors]
+        return list(sectors)
+    return 'all' if split_by_source else None
+
+def _coordinates_to_extent(coordinates):
     coordinate_shape = np.shape(coordinates) 
     if coordinate_shape != (2,) and coordinate_shape != (2,2):
         raise Exception("coordinates must be a singular point or a maximum minimum extent")
@@ -46,68 +618,370 @@ def get_defra_background_concentrations(coordinates : list, background_region :
     if coordinate_shape == (2,):
         coordinates = [coordinates, coordinates]
     
-    valid_regions = ['Greater_London', 'East_of_England', 'Midlands', 'Northern_England',
-                     'Northern_Ireland', 'Scotland', 'Southern_England', 'Wales']
-    if background_region not in valid_regions:
-        raise Exception(f"{background_region} not valid. Please specify one of: {', '.join(valid_regions)}")
+    return coordinates
+
+def _valid_regions():
+    return ['Greater_London', 'East_of_England', 'Midlands', 'Northern_England',
+            'Northern_Ireland', 'Scotland', 'Southern_England', 'Wales']
+
+def _candidate_regions(background_region):
+    '''
+    regions a point may be resolved to. Northern Ireland maps are on the Irish 
+    grid, which overlaps Great Britain coordinates, so a GB point whose region 
+    is not indexed yet would match it. Only consider it when listed explicitly
+    '''
+    if background_region is None:
+        return [region for region in _valid_regions() if region != 'Northern_Ireland']
+    return list(background_region)
+
+def _check_background_inputs(background_region, pollutants):
+    valid_regions = _valid_regions()
+    if isinstance(background_region, str):
+        background_regions = [background_region]
+    elif background_region is None:
+        background_regions = []
+    else:
+        background_regions = list(background_region)
     
+    for region in background_regions:
+        if region not in valid_regions:
+            raise Exception(f"{region} not valid. Please specify one of: {', '.join(valid_regions)}")
     
     valid_pollutants = ['no2', 'nox', 'pm10', 'pm25']
     if not set(pollutants).issubset(valid_pollutants):
         raise Exception(f"At least one specified pollutant is not valid. Please specify one of: {', '.join(valid_pollutants)}")
+    return
+
+def _resolve_point_regions(x, y, background_region, use_cache=True, offline_store=None):
+    '''
+    background region of each point. A single region is used as is, otherwise 
+    the region is looked up in the region index
+    '''
+    if isinstance(background_region, str):
+        return np.full(len(x), background_region, dtype=object)
     
-    url_base = 'https://uk-air.defra.gov.uk/data/laqm-background-maps.php'
-    
-    counter = 1
-    for pollutant in pollutants:
-        params = {'bkgrd-region' : background_region,
-                  'bkgrd-pollutant' : pollutant,
-                  'bkgrd-year' : year,
-                  'action' : 'data',
-                  'year' : base_year,
-                  'submit' : 'Download+CSV'}
-        res = requests.get(url_base, params=params, headers={'User-Agent': 'Chrome'})
-        
-        skip_header_rows = 5
-        if res.ok:
-            data = res.content.decode('utf8')
-            data_split = data.split('\n')[skip_header_rows:]
-            if len(data_split) == 0:
-                raise Exception('Error in API call: ' + data)
-                
-            data_split_rows = [row.split(',') for row in data_split]
-            
-            pollutant_bg_df= pd.DataFrame(data_split_rows[1:], columns = data_split_rows[0])
-        
-        pollutant_bg_df['x'] = pollutant_bg_df['x'].astype(float)
-        pollutant_bg_df['y'] = pollutant_bg_df['y'].astype(float)
-        
-        
-        polluants_bg_at_coords = pollutant_bg_df[(pollutant_bg_df['x']+500 > coordinates[0][0]) &
-                                                (pollutant_bg_df['x']-500 < coordinates[1][0]) &
-                                                (pollutant_bg_df['y']+500 > coordinates[0][1]) &
-                                                (pollutant_bg_df['y']-500 < coordinates[1][1])]
-        
-        if counter == 1:
-            background_concentrations = polluants_bg_at_coords
-        else:
-            background_concentrations = pd.merge(background_concentrations, 
-                                                 polluants_bg_at_coords, 
-                                                 on = ['Local_Auth_Code', 'x', 'y', 'geo_area', 'EU_zone_agglom_01'])
-        
-        counter += 1            
+    candidate_regions = _candidate_regions(background_region)
     
-    if not split_by_source:
-        keep_columns = ['Local_Auth_Code', 'x', 'y', 'geo_area', 'EU_zone_agglom_01']
-        total_columns = [col_n for col_n in list(background_concentrations.columns) if 'Total_' in col_n]
-        
-        keep_columns.extend(total_columns)
-        
-        background_concentrations = background_concentrations[keep_columns]
+    region_index = _get_region_index(use_cache, offline_store)
+    point_regions = region_index.regions_at(x, y, candidate_regions)
+    
+    unresolved = int(pd.isnull(point_regions).sum())
+    if unresolved == len(point_regions) and unresolved > 0:
+        raise Exception("Background region could not be resolved from cached or offline background maps. "
+                        "Run build_background_region_index or specify background_region.")
+    elif unresolved > 0:
+        warnings.warn(f"Background region of {unresolved} point(s) not resolved. These have null concentrations. "
+                      "Run build_background_region_index to index more regions.")
+    
+    return point_regions
+
+def _resolve_extent_regions(coordinates, background_region, use_cache=True, offline_store=None):
+    '''
+    background regions covering the grid squares within an extent
+    '''
+    if isinstance(background_region, str):
+        return [background_region]
+    
+    grid_x_min = int(np.floor(coordinates[0][0]/1000))
+    grid_y_min = int(np.floor(coordinates[0][1]/1000))
+    grid_x_max = max(int(np.ceil(coordinates[1][0]/1000)) - 1, grid_x_min)
+    grid_y_max = max(int(np.ceil(coordinates[1][1]/1000)) - 1, grid_y_min)
+    
+    square_x, square_y = np.meshgrid(np.arange(grid_x_min, grid_x_max+1)*1000 + 500,
+                                     np.arange(grid_y_min, grid_y_max+1)*1000 + 500)
+    
+    candidate_regions = _candidate_regions(background_region)
+    
+    region_index = _get_region_index(use_cache, offline_store)
+    square_regions = region_index.regions_at(square_x.ravel(), square_y.ravel(), candidate_regions)
+    
+    regions = [region for region in pd.unique(square_regions) if region is not None]
+    if len(regions) == 0:
+        raise Exception("Background region could not be resolved from cached or offline background maps. "
+                        "Run build_background_region_index or specify background_region.")
+    
+    return regions
+
+def _get_region_index(use_cache=True, offline_store=None):
+    '''
+    build the region index from the background maps in an offline store, or 
+    from the cache. The cache's index is saved alongside the cached files and 
+    only extended with newly cached regions.
+    '''
+    xy_columns = lambda col_n: col_n in ['x', 'y']
+    
+    if offline_store is not None:
+        store = BackgroundMapStore(offline_store)
+        region_squares = {}
+        for key in store.keys():
+            if key[0] not in region_squares:
+                columns = store.read(key, xy_columns)
+                region_squares[key[0]] = np.unique(_BackgroundRegionIndex.square_keys(columns['x'], columns['y']))
+        return _BackgroundRegionIndex(region_squares)
+    
+    if not use_cache:
+        raise Exception("background_region must be specified when not using the cache or an offline store")
+    
+    cache = get_background_cache()
+    index_path = os.path.join(cache.cache_dir, 'region_index.npz')
+    
+    region_squares = {}
+    if os.path.exists(index_path):
+        with np.load(index_path) as saved_index:
+            region_squares = {region : saved_index[region] for region in saved_index.files}
+    
+    new_region_keys = {}
+    for key in cache.keys():
+        if key[0] not in region_squares and key[0] not in new_region_keys:
+            new_region_keys[key[0]] = key
+    
+    for region, key in new_region_keys.items():
+        cached_path = cache.get_path(key)
+        if cached_path is None:
+            continue
+        with open(cached_path, 'rb') as cached_file:
+            pollutant_bg_df = _read_background_map_csv(cached_file)
+        region_squares[region] = np.unique(_BackgroundRegionIndex.square_keys(pollutant_bg_df['x'], 
+                                                                              pollutant_bg_df['y']))
+    
+    if len(new_region_keys) > 0:
+        np.savez(index_path, **region_squares)
+    
+    return _BackgroundRegionIndex(region_squares)
+
+def _get_background_grid(background_region, year, pollutants, base_year, use_cache=True,
+                         max_workers=4, sectors=None, offline_store=None):
+    '''
+    download (or read from cache) the background map of each pollutant in a 
+    region and combine into a single _BackgroundGrid
+    '''
+    # grids built from cached or stored maps are kept in memory for repeat lookups
+    memo_key = (background_region, str(year), tuple(pollutants), str(base_year), 
+                str(sectors), offline_store)
+    if (use_cache or offline_store is not None) and memo_key in _grid_memo:
+        _grid_memo.move_to_end(memo_key)
+        return _grid_memo[memo_key]
+    
+    map_keys = [(background_region, pollutant, year, base_year) for pollutant in pollutants]
+    pollutant_bg_dfs = _get_background_maps(map_keys, use_cache, max_workers, sectors,
+                                            offline_store)
+    
+    grid = _build_background_grid(pollutant_bg_dfs)
+    
+    if use_cache or offline_store is not None:
+        _grid_memo[memo_key] = grid
+        while len(_grid_memo) > _grid_memo_size:
+            _grid_memo.popitem(last=False)
+    
+    return grid
+
+def _build_background_grid(pollutant_bg_dfs):
+    '''
+    build a _BackgroundGrid from the background maps of a single region, one 
+    per pollutant. Maps are dataframes, or dicts of column arrays when read 
+    from an offline store.
+    '''
+    key_columns = _BackgroundGrid.key_columns
+    
+    grid = None
+    for pollutant_bg_df in pollutant_bg_dfs:
+        x = np.asarray(pollutant_bg_df['x'], dtype=float)
+        y = np.asarray(pollutant_bg_df['y'], dtype=float)
         
-        for col in total_columns:
-            background_concentrations[col] = background_concentrations[col].astype(float)
+        if grid is None:
+            attributes = {col_n : _column_values(pollutant_bg_df, col_n) for col_n in key_columns 
+                          if col_n in pollutant_bg_df.keys() and col_n not in ['x', 'y']}
+            grid = _BackgroundGrid(x, y, attributes)
         
-        background_concentrations.loc['mean'] = background_concentrations[total_columns].mean()
+        value_columns = {col_n : _column_values(pollutant_bg_df, col_n)
+                         for col_n in pollutant_bg_df.keys() if col_n not in key_columns}
+        grid.add_columns(x, y, value_columns)
+    
+    return grid
+
+def _column_values(pollutant_bg_df, col_n):
+    values = pollutant_bg_df[col_n]
+    if isinstance(values, pd.Series):
+        return values.array if isinstance(values.dtype, pd.CategoricalDtype) else values.to_numpy()
+    return values
+
+def _get_background_maps(map_keys, use_cache=True, max_workers=4, sectors=None,
+                         offline_store=None):
+    '''
+    get several defra background maps as dataframes, downloading up to 
+    max_workers at once. map_keys is a list of (region, pollutant, year, base_year).
+    If offline_store is set, maps are read from the store as memory-mapped 
+    columns instead.
+    '''
+    if offline_store is not None:
+        store = BackgroundMapStore(offline_store)
+        return [store.read((region, pollutant, str(year), str(base_year)), 
+                           lambda col_n: _use_column(col_n, sectors))
+                for region, pollutant, year, base_year in map_keys]
+    
+    if max_workers <= 1 or len(map_keys) <= 1:
+        return [_get_background_map(*key, use_cache, sectors) for key in map_keys]
+    
+    _get_session(max_workers)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(map_keys))) as executor:
+        futures = [executor.submit(_get_background_map, *key, use_cache, sectors) 
+                   for key in map_keys]
+        return [future.result() for future in futures]
+
+def _get_background_map(background_region, pollutant, year, base_year, use_cache=True,
+                        sectors=None):
+    '''
+    get a defra background map as a dataframe, from the cache if available
+    '''
+    key = (background_region, pollutant, str(year), str(base_year))
+    
+    if use_cache:
+        cache = get_background_cache()
+        cached_path = cache.get_path(key)
+        if cached_path is None:
+            res = _request_background_map(background_region, pollutant, year, base_year)
+            with res:
+                cached_path = cache.put(key, res.iter_content(chunk_size=1024*1024),
+                                        validate=_check_background_map_file)
         
-    return background_concentrations
\ No newline at end of file
+        try:
+            with open(cached_path, 'rb') as cached_file:
+                return _read_background_map_csv(cached_file, sectors)
+        except Exception:
+            # never keep a file that cannot be parsed, so the next call downloads it again
+            cache.remove(key)
+            raise
+    
+    res = _request_background_map(background_region, pollutant, year, base_year)
+    res.raw.decode_content = True
+    # keep the stream open at end of body so the text wrapper can read to eof
+    res.raw.auto_close = False
+    with res:
+        return _read_background_map_csv(res.raw, sectors)
+
+def _read_background_map_csv(csv_file, sectors=None):
+    '''
+    parse a defra background map csv from a binary file object into a typed 
+    dataframe, without reading the whole file into memory first. Only total 
+    concentration columns are read unless sectors is 'all' or a list of 
+    sector names.
+    '''
+    skip_header_rows = 5
+    
+    with io.TextIOWrapper(csv_file, encoding='utf8', newline='') as text_file:
+        columns = _read_background_map_header(text_file, skip_header_rows)
+    
+        key_columns = _BackgroundGrid.key_columns
+        use_columns = [col_n for col_n in columns if _use_column(col_n, sectors)]
+    
+        dtypes = {col_n : np.float32 for col_n in use_columns if col_n not in key_columns}
+        dtypes.update({'x' : np.float64, 'y' : np.float64, 'Local_Auth_Code' : 'category', 
+                       'geo_area' : 'category', 'EU_zone_agglom_01' : 'category'})
+    
+        try:
+            pollutant_bg_df = pd.read_csv(text_file, header=None, names=columns, usecols=use_columns,
+                                          dtype={col_n : dtype for col_n, dtype in dtypes.items() 
+                                                 if col_n in use_columns},
+                                          na_values=['', 'NULL'])
+        except ValueError as err:
+            raise Exception(f"Error parsing defra background map: {err}")
+    
+    return pollutant_bg_df[use_columns]
+
+def _read_background_map_header(text_file, skip_header_rows=5):
+    '''
+    read the header of a defra background map csv, returning the column names. 
+    Raises if the layout is not as expected, e.g. an html error page
+    '''
+    header_lines = [text_file.readline() for i in range(skip_header_rows)]
+    columns = text_file.readline().strip().split(',')
+    
+    required_columns = ['x', 'y']
+    if (not all(col_n in columns for col_n in required_columns) or 
+        not any(col_n.startswith('Total_') for col_n in columns)):
+        header = ''.join(header_lines) + ','.join(columns)
+        raise Exception("Unexpected defra background map layout. Expected column names on line "
+                        f"{skip_header_rows+1} including x, y and Total_ columns. Start of file:\n{header[:500]}")
+    return columns
+
+def _check_background_map_file(file_path):
+    '''
+    check a downloaded file is a defra background map csv before it is cached
+    '''
+    with open(file_path, 'r', encoding='utf8', errors='replace', newline='') as text_file:
+        _read_background_map_header(text_file)
+    return
+
+def _import_background_map_csv(csv_file, csv_name, base_year, store):
+    '''
+    parse a defra background map csv file and add it to an offline store
+    '''
+    pollutant_bg_df = _read_background_map_csv(csv_file, sectors='all')
+    
+    file_name = os.path.basename(csv_name).replace(' ', '_').replace('-', '_').lower()
+    regions = [region for region in _valid_regions() if region.lower() in file_name]
+    if len(regions) != 1:
+        raise Exception(f"Cannot identify the background region of {csv_name}. The file name must contain one of: "
+                        f"{', '.join(_valid_regions())}")
+    
+    total_column = [col_n for col_n in pollutant_bg_df.columns if col_n.startswith('Total_')][0]
+    _, column_pollutant, year_2d = total_column.split('_')
+    pollutant = column_pollutant.lower().replace('.', '')
+    year = '20' + year_2d
+    
+    key = (regions[0], pollutant, year, str(base_year))
+    store.add(key, pollutant_bg_df)
+    return key
+
+def _use_column(col_n, sectors=None):
+    '''
+    whether a background map column is needed. sectors is None for total 
+    columns only, 'all' for all columns or a list of sector names
+    '''
+    if col_n in _BackgroundGrid.key_columns or col_n.startswith('Total_'):
+        return True
+    if sectors is None or col_n == '':
+        return False
+    if sectors == 'all':
+        return True
+    # sector columns are named {sector}_{pollutant}_{2 digit year}
+    return col_n.rsplit('_', 2)[0] in sectors
+
+def _request_background_map(background_region, pollutant, year, base_year):
+    params = {'bkgrd-region' : background_region,
+              'bkgrd-pollutant' : pollutant,
+              'bkgrd-year' : year,
+              'action' : 'data',
+              'year' : base_year,
+              'submit' : 'Download+CSV'}
+    session = _get_session()
+    res = session.get(DEFRA_BACKGROUND_MAPS_URL, params=params, headers={'User-Agent': 'Chrome'},
+                      stream=True, timeout=120)
+    
+    if not res.ok:
+        raise Exception(f'Error in API call: {res.status_code} {res.reason}')
+    
+    return res
+
+def _get_session(pool_size=1, retries=5, backoff_factor=1):
+    '''
+    get a shared connection pooled session that retries failed requests with
+    exponential backoff. The pool grows to the largest pool_size requested.
+    '''
+    global _session, _session_pool_size
+    
+    with _session_lock:
+        if _session is None or pool_size > _session_pool_size:
+            retry = Retry(total=retries, backoff_factor=backoff_factor,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=['GET'])
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            
+            _session = session
+            _session_pool_size = pool_size
+    
+    return _session
@@ -36,6 +36,7 @@ from BHAQpy._utils import (select_layer_by_name,
                    write_ADMS_input_file)
 
 from BHAQpy.trafficcountpoints import TrafficCountPoints
+from BHAQpy._rastersampling import sample_rasters
 
 class ModelledRoads():  
     
@@ -159,6 +160,14 @@ class ModelledRoads():
         
         self.layer = modelled_road_layer
         self._attr_df = attributes_table_df(modelled_road_layer)
+        
+        # vertex tables are reused until the road geometry or Source IDs are edited
+        self._vertex_tables = {}
+        self._layer_edits = 0
+        for signal in [modelled_road_layer.geometryChanged, modelled_road_layer.featureAdded,
+                       modelled_road_layer.featuresDeleted, modelled_road_layer.afterRollBack]:
+            signal.connect(self._on_layer_edited)
+        modelled_road_layer.attributeValueChanged.connect(self._on_attribute_edited)
         return
         
     def get_attributes_df(self):
@@ -280,6 +289,8 @@ class ModelledRoads():
             Path to save vgt file. If None then no file is saved. The default is None.
         headers_file : str, optional
             A path to a file containing ADMS headers for a vgt file. These can be automatically generated within ADMS (see manual). The default is 'ADMS_template_v5.vgt'.
+        simplify_verticies : bool, optional
+            Whether to simplify road geometry (1.1 m tolerance) before extracting verticies. The default is True.
 
         Returns
         -------
@@ -289,15 +300,9 @@ class ModelledRoads():
         """
         verticies = self._extract_verticies(simplify_verticies)
         
-        #extract
-        vgt_l = []
-        for verticie in verticies.getFeatures():
-            sourceID = verticie['Source ID']
-            X = verticie.geometry().asPoint().x()
-            Y = verticie.geometry().asPoint().y()
-            vgt_l.append([sourceID, X, Y])
-        
-        vgt_data = pd.DataFrame(vgt_l, columns = ['Source name', 'X (m)', 'Y (m)'])
+        vgt_data = pd.DataFrame({'Source name' : verticies['source_ids'][verticies['road_idx']], 
+                                 'X (m)' : verticies['x'], 
+                                 'Y (m)' : verticies['y']})
         
         if output_file is not None:
             write_ADMS_input_file(vgt_data, output_file, headers_file)
@@ -424,8 +429,9 @@ class ModelledRoads():
 
         Parameters
         ----------
-        DTM_layers : str
-            Layer name of the digital terrain model to calculate gradients from.
+        DTM_layers : list
+            Layer names of the digital terrain model tiles to calculate gradients from. Tiles are sampled 
+            in place (no merged raster is created), and where tiles overlap the first in the list is used.
 
         Returns
         -------
@@ -437,17 +443,14 @@ class ModelledRoads():
         if not type(DTM_layers) == list:
             raise Exception("DTM layer must be a list of layer names")
         
-        if len(DTM_layers) > 1:
-            #TODO merge dtms
-            pass
-        else:
-            qsg_proj = self.project.get_project()
-            DTM_layer = select_layer_by_name(DTM_layers[0], qsg_proj)
+        # dtm tiles are sampled in order, so the first tile covering a vertex is used
+        qsg_proj = self.project.get_project()
+        DTM_layers = [select_layer_by_name(DTM_layer_name, qsg_proj) for DTM_layer_name in DTM_layers]
         
         road_verticies = self._extract_verticies(simplify_verticies)
         
         # get a pd series with gradient for each road link
-        road_gradients = _calculate_gradient_by_road(road_verticies, DTM_layer)
+        road_gradients = _calculate_gradient_by_road(road_verticies, DTM_layers, self.layer.crs())
 
         #update layer attrs with gradient+
         modelled_roads_layer = self.layer
@@ -466,54 +469,70 @@ class ModelledRoads():
     
         
     def _extract_verticies(self, simplify_verticies):
-        # run simplify
-        if simplify_verticies:
-            simplified = processing.run("native:simplifygeometries", {'INPUT':self.layer.source(),
-                                        'METHOD':0,'TOLERANCE':1.1,'OUTPUT':'TEMPORARY_OUTPUT'})
-            # run extract road verticies and save to temporary file
-            verticies = processing.run("native:extractvertices", {'INPUT':simplified['OUTPUT'],
-                                        'OUTPUT': 'TEMPORARY_OUTPUT'})
-        else:
-            verticies = processing.run("native:extractvertices", {'INPUT':self.layer.source(),
-                                        'OUTPUT': 'TEMPORARY_OUTPUT'})
+        # vertex table straight from the road geometry, memoised by layer edit state and tolerance
+        simplify_tolerance = 1.1 if simplify_verticies else None
+        edit_state = (id(self.layer), self._layer_edits)
+        key = (*edit_state, simplify_tolerance)
+        
+        if key not in self._vertex_tables:
+            # drop tables from before any edits
+            self._vertex_tables = {table_key : table for table_key, table in self._vertex_tables.items()
+                                   if table_key[:2] == edit_state}
+            
+            vertex_table = _line_vertices(self.layer, simplify_tolerance)
+            for values in vertex_table.values():
+                values.flags.writeable = False
+            self._vertex_tables[key] = vertex_table
         
-        return verticies['OUTPUT']
+        return self._vertex_tables[key]
+    
+    def _on_layer_edited(self, *args):
+        self._layer_edits += 1
+        return
+    
+    def _on_attribute_edited(self, feature_id, field_idx, value):
+        # only Source IDs are held in vertex tables
+        if self.layer.fields().at(field_idx).name() == 'Source ID':
+            self._layer_edits += 1
+        return
 
 # further utility functions
-def _calc_gradient_percentage(distances, heightsAOD):
-
-    # calculate a gradient as percentage using dtm height
-    distances = [i.value() if type(i) == QVariant else float(i) for i in distances]
-    heightsAOD = [i.value() if type(i) == QVariant else float(i) for i in heightsAOD]
+def _road_gradients(road_idx, chainages, heights, n_roads):
+    '''
+    mean gradient (%) of each road from flat per vertex arrays of road index, 
+    chainage along the road and height. Vertices of each road must be in order 
+    along the road. Null gradients (no valid segments) are 0, and gradients 
+    are capped at 30 % (max eft / adms gradient)
+    '''
+    road_idx = np.asarray(road_idx, dtype=np.int64)
+    order = np.argsort(road_idx, kind='stable')
+    road_idx = road_idx[order]
+    chainages = np.asarray(chainages, dtype=float)[order]
+    heights = np.asarray(heights, dtype=float)[order]
     
-    heightsAOD_2 = []
-    for i in heightsAOD:
-        if type(i) == QVariant:
-            #print(type(i.value()))
-            heightsAOD_2.append(NULL)
-        else:
-            heightsAOD_2.append(float(i))
+    # gradient of each segment between consecutive vertices
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percentages = (np.abs(np.diff(heights))/np.abs(np.diff(chainages)))*100
     
-    distances_2 = []
-    for i in distances:
-        if type(i) == QVariant:
-            #print(type(i.value()))
-            distances_2.append(NULL)
-        else:
-            distances_2.append(float(i))
+    # ignore segments spanning two roads, and null heights or distances
+    valid = (road_idx[1:] == road_idx[:-1]) & ~np.isnan(percentages)
+    percentages = np.append(np.where(valid, percentages, 0), 0)
+    valid = np.append(valid, False)
     
-    rises = abs(np.diff(heightsAOD_2))
-    runs = abs(np.diff(distances_2))
-    percentages = pd.DataFrame({'rise' : rises, 'run' : runs})
-    percentages['percentage'] = (percentages['rise']/percentages['run'])*100
+    road_starts = np.flatnonzero(np.concatenate([[True], road_idx[1:] != road_idx[:-1]]))
+    road_sums = np.add.reduceat(percentages, road_starts)
+    road_counts = np.add.reduceat(valid.astype(np.int64), road_starts)
     
-    avg_percentage = np.mean(percentages['percentage']) 
+    gradients = np.zeros(n_roads)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gradients[road_idx[road_starts]] = road_sums/road_counts
     
-    # max eft/ adms gradient is 30%
-    if avg_percentage > 30:
-        avg_percentage = 30
-        
-    return avg_percentage
+    # replace nulls wth zero 
+    gradients[np.isnan(gradients)] = 0
+    # replace values > 30 (max eft can handle)
+    gradients[gradients > 30] = 30
+    
+    return gradients
 
 def _init_modelled_roads_layer(input_modelled_road_layer, save_path, save_layer_name,
                 traffic_count_point_id_col_name, width_col_name, 
@@ -585,7 +604,9 @@ def _copy_input_layer_geometry(modelled_road_layer, input_modelled_road_layer,
         
         dp = modelled_road_layer.dataProvider()
         
-        tcp_register = []
+        # count of roads so far for each tcp, for numbering source ids
+        tcp_counts = {}
+        new_features = []
         #look through each feature - copy the geometry but change the attributes
         for original_feature in modelled_road_layer_simplified.getFeatures():
             # check feeture length - dont add if less than 1 m
@@ -624,57 +645,106 @@ def _copy_input_layer_geometry(modelled_road_layer, input_modelled_road_layer,
                     junction_str = ''
                 
                 tcp_id = str(original_tcp_id)+junction_str
-                number = len([i for i in tcp_register if i == tcp_id]) + 1
+                number = tcp_counts.get(tcp_id, 0) + 1
                 source_id = str(tcp_id) + '.' + str(number)  
                 # tracker
-                tcp_register.append(tcp_id) 
+                tcp_counts[tcp_id] = number
                 
                 #create feature
                 new_feature.setAttributes([None, source_id, str(original_tcp_id), 
                                            original_junction,
                                            original_width, original_speed,
                                            0, original_height, original_canyon_height])
-                #add feature   
-                dp.addFeatures([new_feature])
+                new_features.append(new_feature)
+        
+        #add all features at once
+        dp.addFeatures(new_features)
     
     return modelled_road_layer
     
-def _calculate_gradient_by_road(road_verticies, DTM_layer):
+def _calculate_gradient_by_road(road_verticies, DTM_layers, road_crs):
     '''
-    calculate the gradient for each road, using the etracted verticies layer as
-    an input 
+    calculate the gradient for each road, using the vertex table as an input 
 
     Parameters
     ----------
-    road_verticies : TYPE
-        DESCRIPTION.
+    road_verticies : dict
+        Vertex table from _line_vertices.
+    DTM_layers : list
+        Digital terrain model tiles (QgsRasterLayer) to sample heights from.
+    road_crs : QgsCoordinateReferenceSystem
+        Crs of the vertex coordinates. Verticies are transformed to each tile's crs before sampling where both crs are valid.
 
     Returns
     -------
-    None.
+    pandas.Series
+        Gradient (%) of each road, indexed by Source ID.
 
     '''
     
     # get dtm height at each point
-    vertices_DTM = processing.run("native:rastersampling", {'INPUT':road_verticies,
-                        'RASTERCOPY':DTM_layer.source(),'COLUMN_PREFIX':'DTM_height_',
-                        'OUTPUT':'TEMPORARY_OUTPUT'})
-    
-    vertice_data = attributes_table_df(vertices_DTM['OUTPUT'])
-    
-    # add nan values for missing data
-    vertice_data["distance"] = [np.nan if type(i) == QVariant else i for i in vertice_data["distance"]]
-    vertice_data['DTM_height_1'] = [np.nan if type(i) == QVariant else i for i in vertice_data['DTM_height_1']]
+    heights = sample_rasters(DTM_layers, road_verticies['x'], road_verticies['y'], road_crs)
     
-    # calculate gradient for each road
-    road_gradients = vertice_data.groupby("Source ID").apply(lambda x: _calc_gradient_percentage(x.distance, x['DTM_height_1']))
-    # replace nulls wth zero 
-    road_gradients = road_gradients.fillna(0)
-    
-    # replace values > 30 (max eft can handle)
-    road_gradients[road_gradients > 30] = 30
+    # roads sharing a Source ID get one gradient, and roads with no Source ID are dropped, as in a groupby
+    road_ids, source_ids = pd.factorize(pd.Series(road_verticies['source_ids'], dtype=object), sort=True)
+    vertex_ids = road_ids[road_verticies['road_idx']]
+    has_id = vertex_ids >= 0
+    road_gradients = _road_gradients(vertex_ids[has_id], road_verticies['chainage'][has_id], 
+                                     heights[has_id], len(source_ids))
     
-    return road_gradients
+    return pd.Series(road_gradients, index=source_ids)
+
+def _line_vertices(road_layer, simplify_tolerance=None):
+    '''
+    compact vertex table of a road layer as numpy arrays: the Source ID of each 
+    road ('source_ids'), and for each vertex in order along each road the index 
+    of its road ('road_idx'), its line part ('part_idx'), 'x', 'y' and distance 
+    along the road ('chainage', continuing across parts as extractvertices does)
+    '''
+    source_ids = []
+    road_idx = []
+    part_idx = []
+    xy = []
+    chainage = []
+    
+    n_parts = 0
+    for feature in road_layer.getFeatures():
+        geometry = feature.geometry()
+        if simplify_tolerance is not None and not geometry.isNull():
+            # douglas-peucker, as native:simplifygeometries method 0
+            geometry = geometry.simplify(simplify_tolerance)
+        
+        road_i = len(source_ids)
+        source_ids.append(None if feature['Source ID'] == NULL else feature['Source ID'])
+        if geometry.isNull() or geometry.isEmpty():
+            continue
+        
+        lines = geometry.asMultiPolyline() if geometry.isMultipart() else [geometry.asPolyline()]
+        road_length = 0
+        for line in lines:
+            if len(line) == 0:
+                continue
+            part_xy = np.array([[vertex.x(), vertex.y()] for vertex in line], dtype=float)
+            part_chainage = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(part_xy, axis=0).T))])
+            
+            xy.append(part_xy)
+            chainage.append(road_length + part_chainage)
+            road_idx.append(np.full(len(part_xy), road_i))
+            part_idx.append(np.full(len(part_xy), n_parts))
+            road_length += part_chainage[-1]
+            n_parts += 1
+    
+    if len(xy) == 0:
+        xy = [np.empty((0, 2))]
+        chainage, road_idx, part_idx = [np.empty(0)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    
+    xy = np.concatenate(xy)
+    return {'source_ids' : np.array(source_ids, dtype=object),
+            'road_idx' : np.concatenate(road_idx).astype(np.int64),
+            'part_idx' : np.concatenate(part_idx).astype(np.int64),
+            'x' : xy[:, 0],
+            'y' : xy[:, 1],
+            'chainage' : np.concatenate(chainage)}
 
 def _create_blank_gpkg_layer(gpkg_path: str, layer_name: str, geometry: int,
                             crs: str, schema: QgsFields, append: bool = False,
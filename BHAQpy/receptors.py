@@ -4,17 +4,37 @@ Created on Mon Dec  5 14:46:57 2022
 
 @author: kbenjamin
 """
+import os
 import pandas as pd
 import numpy as np
-from itertools import product
-import time
 
 from geopy.geocoders import Nominatim
-from pyproj import Transformer
+
+from qgis.core import (
+    QgsVectorLayer,
+    QgsFeature,
+    QgsField,
+    QgsGeometry,
+    QgsPointXY,
+    QgsFeatureRequest,
+    QgsRectangle,
+    QgsSpatialIndex
+)
+
+from qgis.PyQt.QtCore import QVariant
 
 from ._utils import (select_layer_by_name,
-                   attributes_table_df)
-from BHAQpy.getdefrabackground import get_defra_background_concentrations
+                   save_to_gpkg,
+                   transform_coordinates)
+from BHAQpy.getdefrabackground import get_defra_background_at_points
+from BHAQpy._geocodecache import ReverseGeocodeCache
+from BHAQpy._geocodepipeline import reverse_geocode_locations
+from BHAQpy._strtree import SegmentSTRtree
+from BHAQpy._addresspoints import (AddressPointIndex, 
+                                   _read_address_points_csv, 
+                                   _join_address_fields)
+
+_geocode_cache = None
 
 
 class Receptors:
@@ -43,12 +63,27 @@ class Receptors:
     get_addresses()
         Extract receptor addresses (from Nomatim)
     
+    get_lat_lon()
+        get the latitude and longitude of each receptor
+    
     get_address_sample()
         Helper function that gets the address of the first receptor. This allows the user to decide which address lines to keep and which to exclude.
     
     get_defra_background_concentrations()
         Get defra background maps concentration for each receptor
     
+    from_grid()
+        Create receptors on a regular or nested grid around the project site
+    
+    thin()
+        Merge receptors within a distance of each other
+    
+    get_nearest_roads()
+        Get the nearest modelled road to each receptor and the distance to it
+    
+    get_receptors_near_roads()
+        Get the receptors within a distance of a modelled road
+    
     """
     def __init__(self, project, source, id_attr_name = 'ID', 
                  min_height_attr_name = 'Height', max_height_attr_name=None,
@@ -105,46 +140,160 @@ class Receptors:
             if attr_name not in receptor_layer_fields:
                 raise Exception(f"{attr_name} not an attribute of {receptor_layer}")
                 
-        receptor_df_raw = attributes_table_df(receptor_layer)
-        receptor_df_raw = receptor_df_raw[attr_names]
-        
-        # reformat data
-        f_receptor_id_col_name = 'ID'
-        f_min_height_col_name = 'Min height' 
-        f_max_height_col_name = 'Max height' 
-        f_sep_distance_col_name = 'Separation'
-                
-        cols = {id_attr_name : f_receptor_id_col_name, 
-                min_height_attr_name : f_min_height_col_name, 
-                max_height_attr_name : f_max_height_col_name, 
-                separation_distance_attr_name : f_sep_distance_col_name}
+        # read IDs, heights and XY in one pass over the features into preallocated arrays
+        # featureCount is -1 when the provider cannot count features
+        n_receptors = max(receptor_layer.featureCount(), 0)
+        ids = np.empty(n_receptors, dtype=object)
+        x = np.empty(n_receptors, dtype=float)
+        y = np.empty(n_receptors, dtype=float)
+        min_heights = np.empty(n_receptors, dtype=object)
+        max_heights = np.empty(n_receptors, dtype=object)
+        sep_distances = np.zeros(n_receptors, dtype=object)
         
-        receptor_df_raw = receptor_df_raw.rename(columns = cols)
+        request = QgsFeatureRequest().setSubsetOfAttributes(attr_names, receptor_layer.fields())
+        n_read = 0
+        for receptor_feature in receptor_layer.getFeatures(request):
+            if n_read == len(ids):
+                # featureCount can be an estimate for some providers
+                ids, x, y, min_heights, max_heights, sep_distances = [
+                    np.concatenate([values, np.zeros(len(values) + 1, dtype=values.dtype)]) 
+                    for values in (ids, x, y, min_heights, max_heights, sep_distances)]
+            
+            point = receptor_feature.geometry().asPoint()
+            ids[n_read] = receptor_feature[id_attr_name]
+            x[n_read] = point.x()
+            y[n_read] = point.y()
+            min_heights[n_read] = receptor_feature[min_height_attr_name]
+            if max_height_attr_name is not None:
+                max_heights[n_read] = receptor_feature[max_height_attr_name]
+            if separation_distance_attr_name is not None:
+                sep_distances[n_read] = receptor_feature[separation_distance_attr_name]
+            n_read += 1
         
         if max_height_attr_name is None:
-            receptor_df_raw[f_max_height_col_name] = receptor_df_raw[f_min_height_col_name]
-        
-        if separation_distance_attr_name is None:
-            receptor_df_raw[f_sep_distance_col_name] = 0
-        
-        # get X and Y values
-        receptor_x_y_values = []
-        receptor_features = receptor_layer.getFeatures()
-        for receptor_feature in receptor_features:
-            receptor_feature_id = receptor_feature[id_attr_name]
-            X = receptor_feature.geometry().asPoint().x()
-            Y = receptor_feature.geometry().asPoint().y()
-            receptor_x_y_values.append([receptor_feature_id, X, Y])
-        
-        receptor_x_y_df = pd.DataFrame(receptor_x_y_values, columns=[f_receptor_id_col_name, 'X', 'Y'])
-        receptor_df = pd.merge(receptor_df_raw, receptor_x_y_df, on=f_receptor_id_col_name) 
-        # re-arrange 
-        receptor_df = receptor_df[[f_receptor_id_col_name, 'X', 'Y', f_min_height_col_name,
-                                  f_max_height_col_name, f_sep_distance_col_name]]
+            max_heights = min_heights.copy()
+        
+        receptor_df = pd.DataFrame({'ID' : ids[:n_read], 
+                                    'X' : x[:n_read], 
+                                    'Y' : y[:n_read], 
+                                    'Min height' : min_heights[:n_read],
+                                    'Max height' : max_heights[:n_read], 
+                                    'Separation' : sep_distances[:n_read]}).infer_objects()
         
         self._attr_df = receptor_df
+        self._lat_lon = None
         return
     
+    @classmethod
+    def from_grid(cls, project, extent_or_buffer, spacing, nested_spacings=None,
+                  height=1.5, building_layer_name=None, layer_name='Grid receptors',
+                  gpkg_path=None):
+        """
+        Create a receptors layer on a regular grid, optionally with finer nested grids close to the site, 
+        and save it to the project geopackage.
+
+        Parameters
+        ----------
+        project : BHAQpy.AQgisProject
+            The AQgisProject to add the receptors layer to.
+        extent_or_buffer : list or float
+            Either an extent [[x_min, y_min], [x_max, y_max]] to fill with receptors, or a distance in m around the project site geometry. 
+            If a distance, receptors further than this from the site are removed.
+        spacing : float
+            Grid spacing in m.
+        nested_spacings : list, optional
+            Finer grids close to the site as a list of (spacing, distance from site) pairs, e.g. [(5, 50), (10, 200)]. The default is None.
+        height : float, optional
+            Receptor height in m. The default is 1.5.
+        building_layer_name : str, optional
+            Name of a polygon layer in the project. Receptors inside these footprints are removed. The default is None.
+        layer_name : str, optional
+            Name of the new receptors layer. The default is 'Grid receptors'.
+        gpkg_path : str, optional
+            Geopackage to save the receptors layer to. The default is None, which uses the project gpkg_path.
+
+        Returns
+        -------
+        Receptors
+            Receptors object of the gridded receptors, with ID and Height attributes.
+
+        """
+        
+        if gpkg_path is None:
+            if 'gpkg_path' not in dir(project):
+                raise Exception("gpkg_path not specified and project gpkg_path not set. Set with set_gpkg_path function")
+            gpkg_path = project.gpkg_path
+        
+        if spacing <= 0:
+            raise Exception("spacing must be greater than 0")
+        
+        # grids of receptor points, finest first so coincident points keep one copy
+        grid_specs = [(spacing, extent_or_buffer)]
+        if nested_spacings is not None:
+            grid_specs.extend(nested_spacings)
+        grid_specs = sorted(grid_specs, key=lambda grid_spec: grid_spec[0])
+        
+        uses_site = nested_spacings is not None or np.ndim(extent_or_buffer) == 0
+        if uses_site and 'site_geometry' not in dir(project):
+            raise Exception('site_geometry not set. Set with set_site_geom function')
+        
+        site_geom = _layer_union_geometry(project.site_geometry) if uses_site else None
+        
+        grid_x = []
+        grid_y = []
+        for grid_spacing, grid_area in grid_specs:
+            if np.ndim(grid_area) == 0:
+                buffer_geom = site_geom.buffer(float(grid_area), 30)
+                buffer_extent = buffer_geom.boundingBox()
+                x, y = _grid_points([[buffer_extent.xMinimum(), buffer_extent.yMinimum()],
+                                     [buffer_extent.xMaximum(), buffer_extent.yMaximum()]], 
+                                    grid_spacing)
+                in_buffer = _points_in_geometry(x, y, buffer_geom)
+                x, y = x[in_buffer], y[in_buffer]
+            else:
+                x, y = _grid_points(grid_area, grid_spacing)
+            
+            grid_x.append(x)
+            grid_y.append(y)
+        
+        grid_x = np.concatenate(grid_x)
+        grid_y = np.concatenate(grid_y)
+        
+        # remove coincident points from overlapping grids
+        _, unique_idx = np.unique(np.round(np.stack([grid_x, grid_y], axis=1), 2), axis=0, 
+                                  return_index=True)
+        unique_idx = np.sort(unique_idx)
+        grid_x, grid_y = grid_x[unique_idx], grid_y[unique_idx]
+        
+        if building_layer_name is not None:
+            building_layer = select_layer_by_name(building_layer_name, project.get_project())
+            in_building = _points_in_layer(grid_x, grid_y, building_layer)
+            grid_x, grid_y = grid_x[~in_building], grid_y[~in_building]
+        
+        print(f"Creating {len(grid_x)} grid receptors")
+        
+        # build all features then add them to the layer in one call
+        crs = project.site_geometry.crs().authid() if uses_site else 'epsg:27700'
+        grid_layer = QgsVectorLayer(f"Point?crs={crs}", layer_name, "memory")
+        dp = grid_layer.dataProvider()
+        dp.addAttributes([QgsField("ID", QVariant.String, "text", 100),
+                          QgsField("Height", QVariant.Double, "double", 7)])
+        grid_layer.updateFields()
+        
+        fields = grid_layer.fields()
+        features = []
+        for receptor_i, (x, y) in enumerate(zip(grid_x, grid_y)):
+            feature = QgsFeature(fields)
+            feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(float(x), float(y))))
+            feature.setAttributes([f'G{receptor_i+1}', float(height)])
+            features.append(feature)
+        dp.addFeatures(features)
+        
+        gpkg_layer = save_to_gpkg(grid_layer, gpkg_path)
+        project.add_layer(gpkg_layer)
+        
+        return cls(project, layer_name, id_attr_name='ID', min_height_attr_name='Height')
+    
     def get_attributes_df(self):
         """
         Get the attributes table as a dataframe
@@ -158,7 +307,25 @@ class Receptors:
         
         return self._attr_df
     
-    def generate_ASP(self, output_file_path):
+    def get_lat_lon(self):
+        """
+        Get the latitude and longitude (epsg:4326) of each receptor. Computed once for all receptors and reused.
+
+        Returns
+        -------
+        lats : numpy.ndarray
+            Latitude of each receptor.
+        lons : numpy.ndarray
+            Longitude of each receptor.
+
+        """
+        if getattr(self, '_lat_lon', None) is None:
+            receptor_df = self.get_attributes_df()
+            self._lat_lon = transform_coordinates(receptor_df['X'].values, receptor_df['Y'].values,
+                                                  "epsg:27700", "epsg:4326")
+        return self._lat_lon
+    
+    def generate_ASP(self, output_file_path, chunk_size=None):
         """
         Create an asp file for receptors. Compute for all heights.
 
@@ -166,78 +333,68 @@ class Receptors:
         ----------
         output_file_path : str
             Path to the file at which asp file will be saved.
+        chunk_size : int, optional
+            If not None, the asp file is written in chunks of about this many receptor heights, so memory use stays bounded 
+            for very large receptor sets, and a summary is returned instead of the full dataframe. The default is None.
 
         Returns
         -------
         asp_df : pandas.DataFrame
-            Pandas dataframe containing all specified point ID, X, Y, Z.
+            Pandas dataframe containing all specified point ID, X, Y, Z. 
+            If chunk_size is set, a dict summarising the file instead: number of receptors, receptor heights, min and max Z, and the file path.
 
         """
         
         receptor_df = self.get_attributes_df()
-        asp_values = []
-        for receptor_feature in receptor_df.values:
-            receptor_feature_id = receptor_feature[0]
-            
-            receptor_feature_min_height = float(receptor_feature[3])
-            receptor_feature_max_height = receptor_feature[4]
-            receptor_feature_sep_dist = receptor_feature[5]
-            
-            # check for null sep distances 
-            if str(receptor_feature_sep_dist) == 'NULL':
-                receptor_feature_sep_dist = 0
-                multiple_heights = False
-            else:
-               receptor_feature_sep_dist = float(receptor_feature_sep_dist) 
-
-            # define the separation distance 
-            if receptor_feature_sep_dist != 0:
-                multiple_heights = True
-            else:
-                multiple_heights = False
-            
-            # define max height of receptor
-            if str(receptor_feature_max_height) == 'NULL':
-                receptor_feature_max_height = float(receptor_feature_min_height)+receptor_feature_sep_dist
-            else:
-                if float(receptor_feature_max_height) == receptor_feature_min_height:
-                    receptor_feature_max_height = receptor_feature_min_height+receptor_feature_sep_dist
-                else:
-                    receptor_feature_max_height = float(receptor_feature_max_height)
-            
-            
-            # get receptor heights
-            if multiple_heights:
-                height_range = np.arange(receptor_feature_min_height, receptor_feature_max_height+0.001, receptor_feature_sep_dist)
-            else:
-                height_range = [receptor_feature_min_height]
-            
-            receptor_z = pd.DataFrame(product([receptor_feature_id], height_range),
-                                          columns=['ID', 'Z']).set_index('ID')
-            
-            receptor_xy = pd.DataFrame([list(receptor_feature[0:3])], columns = ['ID', 'X', 'Y']).set_index('ID')
-            receptor_xyz = receptor_xy.join(receptor_z).reset_index()
-            
-            if multiple_heights:
-                receptor_xyz['ID'] = receptor_xyz['ID'].astype(str) + '(' + receptor_xyz['Z'].astype(str) + ')'
+        
+        if chunk_size is not None:
+            summary = {'receptors' : len(receptor_df), 'receptor_heights' : 0, 
+                       'min_Z' : np.nan, 'max_Z' : np.nan, 'output_file_path' : output_file_path}
             
-            asp_values.extend(receptor_xyz.values)
+            with open(output_file_path, 'w', newline='') as asp_file:
+                for asp_chunk in _iter_asp_chunks(receptor_df, chunk_size):
+                    asp_chunk.to_csv(asp_file, index=False, header=False)
+                    
+                    summary['receptor_heights'] += len(asp_chunk)
+                    summary['min_Z'] = float(np.nanmin([summary['min_Z'], asp_chunk['Z'].min()]))
+                    summary['max_Z'] = float(np.nanmax([summary['max_Z'], asp_chunk['Z'].max()]))
             
-        asp_df = pd.DataFrame(asp_values, columns = ['ID', 'X', 'Y', 'Z'])
+            return summary
+        
+        asp_df = _expand_receptor_heights(receptor_df)
         
         #save to csv
         asp_df.to_csv(output_file_path, index=False, header=False)
         
         return asp_df
     
-    def get_addresses(self, excluded_address_lines_contents=[]):
+    def get_addresses(self, excluded_address_lines_contents=[], use_cache=True, 
+                      rate_limit=1, max_workers=2, checkpoint_path=None, geolocator=None,
+                      address_index=None, max_address_distance=None):
         """
-        Get addresses from Nomatim, using Geopy.
+        Get addresses from Nomatim, using Geopy. Addresses are read from the reverse geocoding cache where available (see BHAQpy.set_geocode_cache),
+        and receptors at the same location are only looked up once. Remaining lookups are rate limited and progress is saved 
+        to checkpoint_path, so an interrupted run can be resumed by calling again with the same checkpoint_path.
 
         Parameters
         ----------
         excluded_address_lines_contents : list
             Names within address to exclude. For example if you wanted to remove London, United Kingdom from every address then excluded_address_lines_contents would be set to ['London', 'United Kingdom'].
+        use_cache : Bool, optional
+            Whether to read and store addresses in the reverse geocoding cache. The default is True.
+        rate_limit : float, optional
+            Maximum geocoder requests per second. Nomatim's usage policy allows 1. The default is 1.
+        max_workers : int, optional
+            Number of requests in flight at once, so waiting on one response does not waste the rate limit. The default is 2.
+        checkpoint_path : str, optional
+            File to save progress to. Removed once all addresses are found. The default is None (no checkpoint).
+        geolocator : geopy.geocoders.Geocoder, optional
+            Geocoder with a reverse() method, e.g. a Nomatim instance pointing to a local server. The default is None (public Nomatim).
+        address_index : str, optional
+            Path to an address point index created with BHAQpy.build_address_point_index. If not None, each receptor gets the address 
+            of the nearest address point with no network access or rate limit, and an 'Address distance' column is added. The default is None.
+        max_address_distance : float, optional
+            When using address_index, receptors with no address point within this distance (m) get no address. The default is None (no limit).
 
         Returns
         -------
@@ -246,22 +403,36 @@ class Receptors:
         """
         receptor_address_df = self.get_attributes_df()
         
-        # settings for transforming receptor locations
-        transformer = Transformer.from_crs("epsg:27700", "epsg:4326")
-        geolocator = Nominatim(user_agent="http")
+        if address_index is not None:
+            # offline lookup of all receptors at once
+            if type(address_index) == str:
+                address_index = AddressPointIndex(address_index)
+            addresses, distances = address_index.query(receptor_address_df['X'].values, 
+                                                       receptor_address_df['Y'].values,
+                                                       max_distance=max_address_distance)
+            
+            receptor_address_df['Address'] = [_format_address(address, excluded_address_lines_contents) 
+                                              for address in addresses]
+            receptor_address_df['Address distance'] = distances
+            self._attr_df = receptor_address_df
+            return receptor_address_df
+        
+        if geolocator is None:
+            geolocator = Nominatim(user_agent="http")
+        cache = get_geocode_cache() if use_cache else None
+        precision = 5 if cache is None else cache.precision
+        
+        lats, lons = self.get_lat_lon()
         
-        # collect address names
-        addresses = []
-        counter = 1
-        for receptor in receptor_address_df.values:
-            print(f"{counter}/{len(receptor_address_df.values)} {receptor[0]}")
-            address_str = _get_address(receptor, transformer, geolocator, 
-                                       excluded_address_lines_contents)
-            addresses.append(address_str)
-            time.sleep(1)
-            counter+=1
-    
-        receptor_address_df['Address'] = addresses
+        addresses = reverse_geocode_locations(lats, lons, geolocator, cache=cache, 
+                                              rate_limit=rate_limit, max_workers=max_workers,
+                                              checkpoint_path=checkpoint_path, precision=precision)
+        
+        if cache is not None:
+            print(f"Geocode cache: {cache.stats()}")
+    
+        receptor_address_df['Address'] = [_format_address(address, excluded_address_lines_contents) 
+                                          for address in addresses]
         self._attr_df = receptor_address_df
         
         return receptor_address_df
@@ -278,24 +449,44 @@ class Receptors:
         """
         receptor_df = self.get_attributes_df()
         receptor = receptor_df.iloc[0].values
-        # settings for transforming receptor locations
-        transformer = Transformer.from_crs("epsg:27700", "epsg:4326")
         geolocator = Nominatim(user_agent="http")
+        cache = get_geocode_cache()
         
-        address_str = _get_address(receptor, transformer, geolocator, 
-                                   excluded_address_lines_contents=[])
+        lats, lons = self.get_lat_lon()
+        lat, lon = lats[0], lons[0]
+        address = cache.get(lat, lon)
+        if address is None:
+            address = _reverse_geocode(lat, lon, geolocator, cache)
+        
+        address_str = _format_address(address, excluded_address_lines_contents=[])
         return [receptor[0], address_str]
     
-    def get_defra_background_concentrations(self, background_region, year):
+    def get_defra_background_concentrations(self, background_region, year, 
+                                            pollutants = ['no2', 'nox', 'pm10', 'pm25'],
+                                            base_year = '2018', offline_store=None, sectors=None,
+                                            interpolate=False):
         """
-        
+        Get defra background maps concentrations at each receptor. Each pollutant background map is downloaded once for all receptors.
 
         Parameters
         ----------
-        background_region : str
+        background_region : str, list or None
             Background region as defined in defra background maps. Options: Greater_London, East_of_England, Midlands, Northern_England, Northern_Ireland, Scotland, Southern_England, Wales.
+            If a list of regions or None (all Great Britain regions), the region of each receptor is resolved from cached or offline background maps (see BHAQpy.build_background_region_index).
+            Northern_Ireland is on the Irish grid, which overlaps Great Britain coordinates, so it is only used when listed explicitly.
         year : int
             The background year to get.
+        pollutants : list, optional
+            Pollutants to get background concentrations for. The default is ['no2', 'nox', 'pm10', 'pm25'].
+        base_year : int, optional
+            Base year of modelled background concentrations. The default is '2018'.
+        offline_store : str, optional
+            Path to an offline background map store created with BHAQpy.import_defra_background_maps. 
+            If not None, background maps are read from the store with no network access. The default is None.
+        sectors : list, optional
+            Source sectors to get in addition to total concentrations, e.g. BHAQpy.ROAD_SECTORS. The default is None.
+        interpolate : Bool, optional
+            If True, concentrations are bilinearly interpolated between 1 km grid square centres, so receptors either side of a square edge do not get a step change. The default is False.
 
         Returns
         -------
@@ -305,54 +496,442 @@ class Receptors:
 
         receptor_df = self.get_attributes_df()
         
-        #get features 
-        receptor_geom = [f for f in self.layer.getFeatures()]
+        receptor_bg_df = get_defra_background_at_points(receptor_df[['X', 'Y']].values, 
+                                                        background_region, year, 
+                                                        pollutants, base_year,
+                                                        ids=receptor_df['ID'].values,
+                                                        offline_store=offline_store,
+                                                        sectors=sectors,
+                                                        interpolate=interpolate)
+        
+        # rows are in receptor order so join by position, which is safe for repeated IDs
+        receptor_data_bg_df = pd.concat([receptor_df.reset_index(drop=True), 
+                                         receptor_bg_df.drop(columns='ID')], axis=1)
+        
+        self._attr_df = receptor_data_bg_df
+        return receptor_data_bg_df
+    
+    def thin(self, tolerance=1.0):
+        """
+        Merge receptors within a distance of each other, keeping the first of each group. Receptors linked by a chain 
+        of points within tolerance of each other are merged together. Reports how many receptor heights this removes from the asp file.
 
-        receptor_grid_sq = []
-        for point in receptor_geom:
-            receptor_ID = point[self.id_attr_name]
-            receptor_geom = point.geometry()
-            
-            receptor_geom_x = receptor_geom.asPoint().x()
-            receptor_geom_y = receptor_geom.asPoint().y()
-            
-            grid_sq_x = np.floor(receptor_geom_x/1000)*1000 + 500
-            grid_sq_y = np.floor(receptor_geom_y/1000)*1000 + 500
-            
-            receptor_grid_sq.append([receptor_ID, grid_sq_x, grid_sq_y])    
+        Parameters
+        ----------
+        tolerance : float, optional
+            Receptors closer than this (m) are merged. The default is 1.0.
 
-        receptor_grid_sq_df = pd.DataFrame(receptor_grid_sq, columns = ['ID', 'Grid sq x', 'Grid sq y'])
+        Returns
+        -------
+        thinned_df : pandas.DataFrame
+            Receptor attributes with merged receptors removed.
+        merged_ids : pandas.DataFrame
+            Mapping of each removed receptor ('Merged ID') to the receptor kept in its place ('ID'), and the distance between them.
 
-        unique_grid_sq = receptor_grid_sq_df.groupby(['Grid sq x', 'Grid sq y'], as_index=False).size()
+        """
+        if tolerance <= 0:
+            raise Exception("tolerance must be greater than 0")
         
-        year_2d = str(year)[-2:]
-        colnames = [f'Total_NO2_{year_2d}', f'Total_NOx_{year_2d}', 
-                    f'Total_PM10_{year_2d}', f'Total_PM2.5_{year_2d}']
+        receptor_df = self.get_attributes_df().reset_index(drop=True)
+        x = receptor_df['X'].to_numpy(dtype=float)
+        y = receptor_df['Y'].to_numpy(dtype=float)
         
-        grid_bg = []
-        for index, row in unique_grid_sq.iterrows():
-            print(row['Grid sq x'],row['Grid sq y'])
-            bg_conc = get_defra_background_concentrations([row['Grid sq x'],row['Grid sq y']], background_region, year)
-            bg_values = bg_conc.iloc[0][colnames].values
-            
-            bg_values = np.append([row['Grid sq x'],row['Grid sq y']], bg_values)
-            grid_bg.append(bg_values)
+        groups = _merge_groups(x, y, tolerance)
+        keep = groups == np.arange(len(groups))
+        
+        thinned_df = receptor_df[keep].reset_index(drop=True)
+        merged = np.flatnonzero(~keep)
+        merged_ids = pd.DataFrame({'ID' : receptor_df['ID'].values[groups[merged]],
+                                   'Merged ID' : receptor_df['ID'].values[merged],
+                                   'Distance' : np.hypot(x[merged] - x[groups[merged]], 
+                                                         y[merged] - y[groups[merged]])})
+        
+        heights_before = _receptor_heights(receptor_df)['height_counts'].sum()
+        heights_after = _receptor_heights(thinned_df)['height_counts'].sum()
+        print(f"Merged {len(merged)} receptors within {tolerance} m: {len(receptor_df)} receptors to {len(thinned_df)}. "
+              f"ASP receptor heights {heights_before} to {heights_after} ({heights_before - heights_after} saved)")
+        
+        self._attr_df = thinned_df
+        self._lat_lon = None
+        return thinned_df, merged_ids
+    
+    def get_nearest_roads(self, modelled_roads, max_distance=None):
+        """
+        Get the nearest modelled road to each receptor, and the distance to it.
+
+        Parameters
+        ----------
+        modelled_roads : BHAQpy.ModelledRoads
+            Modelled roads to measure distances to.
+        max_distance : float, optional
+            Only look for roads within this distance (m). Receptors with no road within this distance get no nearest road 
+            and an infinite distance. Setting this makes the search faster. The default is None (no limit).
 
-        grid_bg_df = pd.DataFrame(grid_bg, columns = ['Grid sq x', 'Grid sq y']+colnames)
+        Returns
+        -------
+        Pandas dataframe of receptor attributes with the 'Nearest road' (Source ID) and 'Road distance' (m) of each receptor.
 
-        receptor_bg_df = pd.merge(receptor_grid_sq_df, grid_bg_df, left_on=['Grid sq x', 'Grid sq y'], 
-                                    right_on = ['Grid sq x', 'Grid sq y'])
+        """
+        receptor_df = self.get_attributes_df()
         
-        receptor_data_bg_df = pd.merge(receptor_df, receptor_bg_df, on='ID')
+        road_ids, segments = _road_segments(modelled_roads._extract_verticies(simplify_verticies=False))
+        if len(segments) == 0:
+            raise Exception("Modelled roads layer has no road geometry")
         
-        self._attr_df = receptor_data_bg_df
-        return receptor_data_bg_df
+        road_tree = SegmentSTRtree(segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3])
+        segment_idx, distances = road_tree.nearest(receptor_df['X'].values, receptor_df['Y'].values,
+                                                   max_distance=max_distance)
+        
+        nearest_roads = np.full(len(segment_idx), None, dtype=object)
+        found = segment_idx >= 0
+        nearest_roads[found] = road_ids[segment_idx[found]]
+        
+        receptor_df['Nearest road'] = nearest_roads
+        receptor_df['Road distance'] = distances
+        self._attr_df = receptor_df
+        
+        return receptor_df
+    
+    def get_receptors_near_roads(self, modelled_roads, distance=200):
+        """
+        Screen receptors by distance from modelled roads.
+
+        Parameters
+        ----------
+        modelled_roads : BHAQpy.ModelledRoads
+            Modelled roads to measure distances to.
+        distance : float, optional
+            Screening distance from the nearest road (m). The default is 200.
+
+        Returns
+        -------
+        Pandas dataframe of the receptors within distance of a modelled road, with their 'Nearest road' and 'Road distance'.
+
+        """
+        receptor_df = self.get_nearest_roads(modelled_roads, max_distance=distance)
+        return receptor_df[receptor_df['Road distance'] <= distance]
+
+def set_geocode_cache(cache_path=None, precision=5):
+    """
+    Configure the persistent cache of reverse geocoded receptor addresses. The cache is shared by all projects using the same file.
+
+    Parameters
+    ----------
+    cache_path : str, optional
+        Path to the SQLite database file. The default is None, which uses ~/.BHAQpy/reverse_geocode_cache.sqlite.
+    precision : int, optional
+        Number of decimal places latitude and longitude are rounded to when looking up cached addresses. 
+        The default is 5 (about 1 m).
+
+    Returns
+    -------
+    BHAQpy._geocodecache.ReverseGeocodeCache
+        The cache object. Use .stats() to get hit/miss statistics or .clear() to empty the cache.
+
+    """
+    global _geocode_cache
+    _geocode_cache = ReverseGeocodeCache(cache_path, precision)
+    return _geocode_cache
+
+def get_geocode_cache():
+    """
+    Get the persistent cache of reverse geocoded receptor addresses, creating one with default settings if not already set.
+
+    Returns
+    -------
+    BHAQpy._geocodecache.ReverseGeocodeCache
+        The cache object.
+
+    """
+    if _geocode_cache is None:
+        return set_geocode_cache()
+    return _geocode_cache
+
+def build_address_point_index(source, index_path, address_fields=['Address'], 
+                               x_field='X', y_field='Y', layer_name=None):
+    """
+    Build an index of address points (e.g. UPRN points with addresses) for offline reverse geocoding, and save it. 
+    Pass index_path as address_index to Receptors.get_addresses. Requires scipy.
+
+    Parameters
+    ----------
+    source : str
+        A csv file with coordinate and address columns, or a geopackage/shapefile of address points.
+    index_path : str
+        Path to save the index file to.
+    address_fields : list, optional
+        Fields making up the address, joined with ', ' in this order. Blank fields are skipped. The default is ['Address'].
+    x_field : str, optional
+        Column with the X coordinate (EPSG:27700) in a csv source. The default is 'X'.
+    y_field : str, optional
+        Column with the Y coordinate (EPSG:27700) in a csv source. The default is 'Y'.
+    layer_name : str, optional
+        Layer name within a geopackage source. The default is None.
 
-def _get_address(receptor, transformer, geolocator, excluded_address_lines_contents):
-    lat,lon = transformer.transform(receptor[1], receptor[2])
+    Returns
+    -------
+    BHAQpy._addresspoints.AddressPointIndex
+        The saved index. Use .query() to look up addresses at any coordinates.
+
+    """
+    if not os.path.exists(source):
+        raise Exception(f"source {source} not found")
+    
+    if type(address_fields) == str:
+        address_fields = [address_fields]
+    
+    extension = os.path.splitext(source)[1].lower()
+    if extension == '.csv':
+        x, y, addresses = _read_address_points_csv(source, x_field, y_field, address_fields)
+    elif extension in ['.gpkg', '.shp']:
+        if extension == '.gpkg':
+            if type(layer_name) != str:
+                raise Exception("source is a geopackage. layer_name must be set to a valid layer within this geopackage.")
+            layer = QgsVectorLayer(source+'|layername='+layer_name, layer_name, 'ogr')
+        else:
+            layer = QgsVectorLayer(source, 'address points', 'ogr')
+        x, y, addresses = _read_address_points_layer(layer, address_fields)
+    else:
+        raise Exception("source must be a csv file, geopackage or shapefile of address points")
+    
+    return AddressPointIndex.build(x, y, addresses, index_path)
+
+def _grid_points(extent, spacing):
+    '''
+    points of a regular grid covering an extent. Grid lines are at multiples 
+    of spacing so nested grids line up
+    '''
+    x_min = np.floor(extent[0][0]/spacing)*spacing
+    y_min = np.floor(extent[0][1]/spacing)*spacing
+    
+    grid_x, grid_y = np.meshgrid(np.arange(x_min, extent[1][0] + spacing/2, spacing),
+                                 np.arange(y_min, extent[1][1] + spacing/2, spacing))
+    return grid_x.ravel(), grid_y.ravel()
+
+def _layer_union_geometry(layer):
+    return QgsGeometry.unaryUnion([feature.geometry() for feature in layer.getFeatures()])
+
+def _points_in_geometry(x, y, geometry):
+    '''
+    whether each point is within a geometry
+    '''
+    engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+    engine.prepareGeometry()
+    
+    inside = np.zeros(len(x), dtype=bool)
+    for point_i, (point_x, point_y) in enumerate(zip(x, y)):
+        point = QgsGeometry.fromPointXY(QgsPointXY(float(point_x), float(point_y)))
+        inside[point_i] = engine.intersects(point.constGet())
+    return inside
+
+def _points_in_layer(x, y, layer):
+    '''
+    whether each point is within any polygon of a layer, using a spatial index
+    '''
+    spatial_index = QgsSpatialIndex(layer.getFeatures())
+    geometries = {}
+    engines = {}
+    
+    inside = np.zeros(len(x), dtype=bool)
+    for point_i, (point_x, point_y) in enumerate(zip(x, y)):
+        point_x, point_y = float(point_x), float(point_y)
+        candidate_ids = spatial_index.intersects(QgsRectangle(point_x, point_y, point_x, point_y))
+        if len(candidate_ids) == 0:
+            continue
+        
+        point = QgsGeometry.fromPointXY(QgsPointXY(point_x, point_y))
+        for feature_id in candidate_ids:
+            if feature_id not in engines:
+                geometries[feature_id] = layer.getFeature(feature_id).geometry()
+                engines[feature_id] = QgsGeometry.createGeometryEngine(geometries[feature_id].constGet())
+                engines[feature_id].prepareGeometry()
+            
+            if engines[feature_id].intersects(point.constGet()):
+                inside[point_i] = True
+                break
+    return inside
+
+def _merge_groups(x, y, tolerance):
+    '''
+    index of the first point in each point's group, where groups join points 
+    within tolerance of each other. Points are hashed to a grid of tolerance 
+    sized cells so only points in neighbouring cells are compared
+    '''
+    n_points = len(x)
+    cells = pd.DataFrame({'cx' : np.floor(x/tolerance).astype(np.int64),
+                          'cy' : np.floor(y/tolerance).astype(np.int64),
+                          'i' : np.arange(n_points)})
+    
+    # pairs of points in the same or a neighbouring cell, each pair once
+    pairs = []
+    for dx, dy in [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]:
+        shifted = cells.assign(cx=cells['cx'] + dx, cy=cells['cy'] + dy)
+        cell_pairs = shifted.merge(cells, on=['cx', 'cy'], suffixes=('_a', '_b'))
+        if (dx, dy) == (0, 0):
+            cell_pairs = cell_pairs[cell_pairs['i_a'] < cell_pairs['i_b']]
+        pairs.append(cell_pairs[['i_a', 'i_b']].to_numpy())
+    pairs = np.concatenate(pairs)
+    
+    close = np.hypot(x[pairs[:, 0]] - x[pairs[:, 1]], y[pairs[:, 0]] - y[pairs[:, 1]]) < tolerance
+    pairs = pairs[close]
+    
+    # label each group with its lowest index, spreading labels along pairs until nothing changes
+    groups = np.arange(n_points)
+    while len(pairs) > 0:
+        pair_min = np.minimum(groups[pairs[:, 0]], groups[pairs[:, 1]])
+        new_groups = groups.copy()
+        np.minimum.at(new_groups, pairs[:, 0], pair_min)
+        np.minimum.at(new_groups, pairs[:, 1], pair_min)
+        new_groups = new_groups[new_groups]
+        if np.array_equal(new_groups, groups):
+            break
+        groups = new_groups
+    
+    return groups
+
+def _expand_receptor_heights(receptor_df):
+    '''
+    expand receptors to one row per receptor height, with ID, X, Y, Z columns. 
+    Receptors with a separation distance get heights from min height to max 
+    height (inclusive) at that separation, and an ID suffixed with the height.
+    '''
+    receptor_heights = _receptor_heights(receptor_df)
+    return _expand_heights(receptor_heights, slice(None))
+
+def _iter_asp_chunks(receptor_df, chunk_size):
+    '''
+    yield the expanded receptor heights in chunks of about chunk_size rows. 
+    Chunks always hold whole receptors
+    '''
+    receptor_heights = _receptor_heights(receptor_df)
+    height_counts = receptor_heights['height_counts']
+    
+    # group receptors by the chunk their first row falls in
+    first_rows = np.cumsum(height_counts) - height_counts
+    chunk_ids = first_rows // chunk_size
+    chunk_starts = np.concatenate([[0], np.flatnonzero(np.diff(chunk_ids)) + 1, [len(chunk_ids)]])
+    
+    for chunk_start, chunk_end in zip(chunk_starts[:-1], chunk_starts[1:]):
+        yield _expand_heights(receptor_heights, slice(chunk_start, chunk_end))
+
+def _receptor_heights(receptor_df):
+    '''
+    per receptor arrays needed to expand receptors into heights
+    '''
+    min_heights = receptor_df['Min height'].to_numpy(dtype=float)
+    
+    # null separation distances mean a single height
+    sep_distances = receptor_df['Separation'].to_numpy(dtype=object)
+    sep_null = _is_null(sep_distances)
+    sep_distances = np.where(sep_null, 0, sep_distances).astype(float)
+    multiple_heights = sep_distances != 0
+    
+    # null max heights, or max heights equal to min, give one height above min
+    max_heights = receptor_df['Max height'].to_numpy(dtype=object)
+    max_null = _is_null(max_heights)
+    max_heights = np.where(max_null, np.nan, max_heights).astype(float)
+    max_heights = np.where(max_null | (max_heights == min_heights), 
+                           min_heights + sep_distances, max_heights)
+    
+    # number of heights, as np.arange(min, max+0.001, sep) for each receptor
+    height_counts = np.ones(len(min_heights), dtype=np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        arange_counts = np.ceil((max_heights + 0.001 - min_heights)/sep_distances)
+    height_counts[multiple_heights] = np.maximum(arange_counts[multiple_heights], 1)
+    
+    return {'ids' : receptor_df['ID'].to_numpy(dtype=object),
+            'x' : receptor_df['X'].to_numpy(dtype=float),
+            'y' : receptor_df['Y'].to_numpy(dtype=float),
+            'min_heights' : min_heights,
+            'sep_distances' : sep_distances,
+            'multiple_heights' : multiple_heights,
+            'height_counts' : height_counts}
+
+def _expand_heights(receptor_heights, receptors):
+    '''
+    expand a slice of receptors from _receptor_heights into an asp dataframe
+    '''
+    height_counts = receptor_heights['height_counts'][receptors]
+    min_heights = receptor_heights['min_heights'][receptors]
+    sep_distances = receptor_heights['sep_distances'][receptors]
+    
+    receptor_idx = np.repeat(np.arange(len(height_counts)), height_counts)
+    height_idx = np.arange(len(receptor_idx)) - np.repeat(np.cumsum(height_counts) - height_counts, 
+                                                          height_counts)
+    
+    # match np.arange's float steps exactly: start + i*((start+step)-start)
+    start = min_heights[receptor_idx]
+    first_step = start + sep_distances[receptor_idx]
+    z = start + height_idx*(first_step - start)
+    z[height_idx == 1] = first_step[height_idx == 1]
+    
+    asp_ids = receptor_heights['ids'][receptors][receptor_idx]
+    multiple_rows = receptor_heights['multiple_heights'][receptors][receptor_idx]
+    if multiple_rows.any():
+        asp_ids[multiple_rows] = (pd.Series(asp_ids[multiple_rows]).astype(str) + '(' +
+                                  pd.Series(z[multiple_rows]).astype(str) + ')').to_numpy(dtype=object)
+    
+    asp_df = pd.DataFrame({'ID' : asp_ids, 
+                           'X' : receptor_heights['x'][receptors][receptor_idx], 
+                           'Y' : receptor_heights['y'][receptors][receptor_idx], 
+                           'Z' : z})
+    return asp_df
+
+def _is_null(values):
+    '''
+    whether each value is a QGIS NULL or missing
+    '''
+    values = pd.Series(values, dtype=object)
+    return (values.astype(str) == 'NULL').to_numpy() | values.isnull().to_numpy()
+
+def _read_address_points_layer(layer, address_fields):
+    if not layer.isValid():
+        raise Exception(f"Could not load address points layer {layer.source()}")
+    
+    layer_fields = [field.name() for field in layer.fields()]
+    for address_field in address_fields:
+        if address_field not in layer_fields:
+            raise Exception(f"{address_field} not an attribute of {layer.name()}")
+    
+    x = []
+    y = []
+    address_lines = []
+    request = QgsFeatureRequest().setSubsetOfAttributes(address_fields, layer.fields())
+    for feature in layer.getFeatures(request):
+        point = feature.geometry().asPoint()
+        x.append(point.x())
+        y.append(point.y())
+        address_lines.append([feature[address_field] for address_field in address_fields])
+    
+    # QGIS NULLs become blank address lines
+    address_df = pd.DataFrame(address_lines, columns=address_fields, dtype=object)
+    address_df = address_df.mask(address_df.apply(_is_null).astype(bool))
+    return np.array(x, dtype=float), np.array(y, dtype=float), _join_address_fields(address_df)
+
+def _road_segments(road_verticies):
+    '''
+    Source ID and (x0, y0, x1, y1) of every straight segment of every road, 
+    from a ModelledRoads vertex table
+    '''
+    # consecutive vertices in the same line part make a segment
+    same_part = road_verticies['part_idx'][1:] == road_verticies['part_idx'][:-1]
+    x = road_verticies['x']
+    y = road_verticies['y']
+    segments = np.column_stack([x[:-1], y[:-1], x[1:], y[1:]])[same_part]
+    road_ids = road_verticies['source_ids'][road_verticies['road_idx'][:-1][same_part]]
+    return road_ids, segments
+
+def _reverse_geocode(lat, lon, geolocator, cache=None):
     location = geolocator.reverse(f"{lat}, {lon}")
-    address = location.address
+    address = None if location is None else location.address
+    if cache is not None and address is not None:
+        cache.put(lat, lon, address)
+    return address
+
+def _format_address(address, excluded_address_lines_contents):
+    if address is None:
+        return None
     address_split = address.split(', ')
     address_select = [i for i in address_split if i not in excluded_address_lines_contents]
     address_str = ', '.join(address_select)
-    return address_str
\ No newline at end of file
+    return address_str